@@ -1,14 +1,14 @@
 from flask import Flask
 from flask_bootstrap import Bootstrap
 from flask_mail import Mail
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from config import config
 from flask_pagedown import PageDown
+from .replicas import RoutingSQLAlchemy
 
 bootstrap = Bootstrap()
 mail = Mail()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
 pageDown = PageDown()
@@ -25,6 +25,33 @@ def create_app(config_name: str):
     login_manager.init_app(app)
     pageDown.init_app(app)
 
+    from .replicas import replicas
+    replicas.init_app(app)
+
+    from .counts import count_cache
+    count_cache.init_app(app)
+
+    from .last_seen import last_seen
+    last_seen.init_app(app)
+
+    from .page_cache import page_cache
+    page_cache.init_app(app)
+
+    from .identity import identity_cache
+    identity_cache.init_app(app)
+
+    from .hashing import hasher
+    hasher.init_app(app)
+
+    from .email import mail_queue
+    mail_queue.init_app(app)
+
+    from .metrics import metrics
+    metrics.init_app(app)
+
+    from .profiling import profiler
+    profiler.init_app(app)
+
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
@@ -1,28 +1,154 @@
-from flask import g, jsonify
+import hashlib, hmac, os, time
+from collections import defaultdict
+from flask import g, jsonify, current_app
+from .. import db
 from ..models import User
+from ..cache import TTLCache
+from ..replicas import primary
+from ..profiling import profiler
+from ..identity import identity_changed, snapshot, restore
 from flask_httpauth import HTTPBasicAuth
 from .errors import unauthorized, forbidden
 from . import api
 auth = HTTPBasicAuth()
 
 
+# Credentials are cached under an HMAC with a key that never leaves the process
+_CREDENTIALS_KEY = os.urandom(32)
+
+
+class _AuthCacheState:
+    """ Verified tokens mapped to identity snapshots of their users """
+
+    def __init__(self, maxsize, ttl):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Bumped by identity changes, entries stored under an older generation are ignored
+        self.generations = defaultdict(int)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """ Identity snapshot stored under `key`, None when missing or stale """
+
+        entry = self.entries.get(key)
+        if entry is not None and entry['generation'] == self.generations[entry['user_id']]:
+            self.hits += 1
+            return entry['identity']
+
+        self.misses += 1
+        return None
+
+    def get(self, key):
+        identity = self.lookup(key)
+        return restore(identity) if identity is not None else None
+
+    def set(self, key, user, ttl=None):
+        self.entries.set(key, {
+            'user_id': user.id,
+            'identity': snapshot(user),
+            'generation': self.generations[user.id]
+        }, ttl=ttl)
+
+    def invalidate(self, user_ids):
+        if user_ids is None:
+            self.entries.clear()
+        else:
+            for user_id in user_ids:
+                self.generations[user_id] += 1
+
+    def stats(self):
+        return { 'size': len(self.entries), 'hits': self.hits, 'misses': self.misses }
+
+
+@api.record_once
+def init_auth_caches(state):
+    app = state.app
+    app.extensions['token_cache'] = _AuthCacheState(app.config['APP_TOKEN_CACHE_SIZE'],
+                                                    app.config['APP_TOKEN_CACHE_TTL'])
+    # Keys of verified credentials, they include the password hash and stop matching
+    # in every worker once the password changes
+    app.extensions['credentials_cache'] = TTLCache(maxsize=app.config['APP_CREDENTIALS_CACHE_SIZE'],
+                                                   ttl=app.config['APP_CREDENTIALS_CACHE_TTL'])
+
+
+@identity_changed.connect
+def invalidate_auth_caches(app, user_ids):
+    if 'token_cache' in app.extensions:
+        app.extensions['token_cache'].invalidate(user_ids)
+
+
+def token_key(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def credentials_key(email, password, password_hash):
+    return hmac.new(_CREDENTIALS_KEY, f'{email}\0{password}\0{password_hash}'.encode('utf-8'),
+                    hashlib.sha256).digest()
+
+
+def verify_token(token):
+    """ User of a valid token, repeated tokens are served from memory until their expiration """
+
+    state = current_app.extensions['token_cache']
+    digest = token_key(token)
+    user = state.get(digest)
+    if user is not None:
+        return user
+
+    data = User.decode_auth_token(token)
+    if data is None:
+        return None
+
+    with primary():
+        user = User.query.options(db.joinedload(User.role)).get(data['id'])
+
+    if user is None:
+        return None
+
+    ttl = min(data['exp'] - time.time(), current_app.config['APP_TOKEN_CACHE_TTL'])
+    if ttl > 0:
+        state.set(digest, user, ttl=ttl)
+
+    return user
+
+
+def verify_credentials(email, password):
+    """ User matching email and password, repeated pairs skip the password hash for a while
+
+    The user is always loaded, role and account changes apply at once and a new password
+    hash no longer matches the cached key.
+    """
+
+    with primary():
+        user = User.query.options(db.joinedload(User.role)).filter_by(email=email).first()
+
+    if user is None or user.password_hash is None:
+        return None
+
+    state = current_app.extensions['credentials_cache']
+    key = credentials_key(email, password, user.password_hash)
+    if state.get(key) is None:
+        if not user.verify_password(password):
+            return None
+
+        state.set(key, True)
+
+    return user
+
+
 @auth.verify_password
 def verify_password(email_or_token, password):
     if email_or_token == '':
         return False
 
     if password == '':
-        g.current_user = User.verify_auth_token(email_or_token)
-        g.token_user = True
+        g.current_user = verify_token(email_or_token)
+        g.token_used = True
         return g.current_user is not None
 
-    user = User.query.filter_by(email=email_or_token).first()
-    if not user:
-        return False
-
-    g.current_user = user
+    g.current_user = verify_credentials(email_or_token, password)
     g.token_used = False
-    return user.verify_password(password)
+    return g.current_user is not None
 
 
 @auth.error_handler
@@ -36,6 +162,8 @@ def before_request():
     if not g.current_user.is_anonymous and not g.current_user.confirmed:
         return forbidden("Unconfirmed account")
 
+    profiler.authorized(g.current_user)
+
 
 @api.route('/tokens/', methods=['POST'])
 def get_token():
@@ -0,0 +1,80 @@
+from flask import current_app, jsonify, request, url_for
+from .. import db
+from ..exceptions import ValidationError
+from .params import requested_fields
+
+
+def _check_size(count):
+    limit = current_app.config['APP_API_MAX_BATCH']
+    if count > limit:
+        raise ValidationError(f'Batches are limited to {limit} items')
+
+
+def requested_ids():
+    """ Ids of `?ids=1,2,3`, None when the request is not a batch read """
+
+    ids = request.args.get('ids')
+    if ids is None:
+        return None
+
+    try:
+        ids = list(dict.fromkeys(int(id) for id in ids.split(',') if id.strip()))
+    except ValueError:
+        raise ValidationError('Ids have to be integers')
+
+    _check_size(len(ids))
+    return ids
+
+
+def batch_json(key, ids, rows, fields=None):
+    found = { obj.id: obj for obj in rows }
+    return {
+        key: [found[id].to_json(fields) for id in ids if id in found],
+        'missing': [id for id in ids if id not in found]
+    }
+
+
+def get_batch(model, ids, key):
+    """ Rows of `model` with `ids` loaded by one IN query, in the requested order """
+
+    return jsonify(batch_json(key, ids, model.query.filter(model.id.in_(ids)) if ids else (), requested_fields()))
+
+
+def create_batch(model, items, key, endpoint, build):
+    """ Creates every valid item of a JSON array in one transaction
+
+    `build(item)` returns a new row of `model` or raises ValidationError. Items are answered
+    in order with the status a single create would have had, invalid ones are skipped.
+    """
+
+    _check_size(len(items))
+    results, created = [], []
+    for item in items:
+        try:
+            if not isinstance(item, dict):
+                raise ValidationError('Item has to be an object')
+
+            obj = build(item)
+        except ValidationError as e:
+            results.append({ 'status': 400, 'error': 'bad request', 'message': e.args[0] })
+            continue
+
+        db.session.add(obj)
+        created.append(obj)
+        results.append(obj)
+
+    db.session.flush()
+    ids = [obj.id for obj in created]
+    db.session.commit()
+    # Reloads the expired rows and their server defaults at once instead of one SELECT each
+    if ids:
+        model.query.filter(model.id.in_(ids)).all()
+
+    return jsonify({
+        'results': [result if isinstance(result, dict) else {
+            'status': 201,
+            'location': url_for(endpoint, id=result.id),
+            key: result.to_json()
+        } for result in results],
+        'created': len(created)
+    }), 201 if created else 400
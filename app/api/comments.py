@@ -3,29 +3,39 @@ from .. import db
 from ..models import Post, Permission, Comment
 from . import api
 from .decorators import permission_required
+from ..pagination import CursorPagination
+from .params import requested_fields, page_size, list_args
+from .batch import requested_ids, get_batch, create_batch
 
 
 @api.get('/comments/')
 def get_comments():
-    page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
-        error_out=False
+    ids = requested_ids()
+    if ids is not None:
+        return get_batch(Comment, ids, 'comments')
+
+    pagination = CursorPagination(
+        Comment.query, (Comment.timestamp, Comment.id), request.args.get('cursor'),
+        per_page=page_size('APP_COMMENTS_PER_PAGE'),
+        count_mode=request.args.get('count', current_app.config['APP_API_COUNT_MODE'])
     )
 
     comments = pagination.items
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_comments', page=page-1)
+        prev = url_for('api.get_comments', cursor=pagination.prev_cursor, **list_args())
 
     next = None
     if pagination.has_next:
-        next = url_for('api.get_comments', page=page+1)
+        next = url_for('api.get_comments', cursor=pagination.next_cursor, **list_args())
 
+    fields = requested_fields()
     return jsonify({
-        'comments': [comment.to_json() for comment in comments],
+        'comments': [comment.to_json(fields) for comment in comments],
         'prev': prev,
         'next': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
         'count': pagination.total
     })
 
@@ -33,31 +43,34 @@ def get_comments():
 @api.get('/comments/<int:id>')
 def get_comment(id):
     comment = Comment.query.get_or_404(id)
-    return jsonify(comment.to_json())
+    return jsonify(comment.to_json(requested_fields()))
 
 
 @api.get('/posts/<int:id>/comments/')
 def get_post_comments(id):
     post = Post.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
-        error_out=False
+    pagination = CursorPagination(
+        post.comments, (Comment.timestamp, Comment.id), request.args.get('cursor'),
+        per_page=page_size('APP_COMMENTS_PER_PAGE'), descending=False,
+        count_mode=request.args.get('count', current_app.config['APP_API_COUNT_MODE'])
     )
 
     comments = pagination.items
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_post_comments', id=id, page=page-1)
+        prev = url_for('api.get_post_comments', id=id, cursor=pagination.prev_cursor, **list_args())
 
     next = None
     if pagination.has_next:
-        next = url_for('api.get_post_comments', id=id, page=page+1)
+        next = url_for('api.get_post_comments', id=id, cursor=pagination.next_cursor, **list_args())
 
+    fields = requested_fields()
     return jsonify({
-        'comments': [comment.to_json() for comment in comments],
+        'comments': [comment.to_json(fields) for comment in comments],
         'prev': prev,
         'next': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
         'count': pagination.total
     })
 
@@ -66,9 +79,17 @@ def get_post_comments(id):
 @permission_required(Permission.COMMENT)
 def new_post_comment(id):
     post = Post.query.get_or_404(id)
-    comment = Comment.from_json(request.json)
-    comment.author = g.current_user
-    comment.post = post
+
+    def build(json_comment):
+        comment = Comment.from_json(json_comment)
+        comment.author = g.current_user
+        comment.post = post
+        return comment
+
+    if isinstance(request.json, list):
+        return create_batch(Comment, request.json, 'comment', 'api.get_comment', build)
+
+    comment = build(request.json)
     db.session.add(comment)
     db.session.commit()
     return jsonify(comment.to_json()), 201, { 'Location': url_for('api.get_comment', id=comment.id) }
@@ -0,0 +1,62 @@
+import datetime
+from flask import current_app, json, request, stream_with_context
+from werkzeug.http import parse_date
+from . import api
+from ..exceptions import ValidationError
+from ..models import User, Post
+from .params import requested_fields
+
+
+def _since():
+    since = request.args.get('since')
+    if since is None:
+        return None
+
+    # ISO 8601, or the HTTP date format timestamps are serialized in
+    try:
+        since = datetime.datetime.fromisoformat(since)
+    except ValueError:
+        since = parse_date(since)
+        if since is None:
+            raise ValidationError('Invalid since timestamp')
+
+    # Timestamps are stored as naive UTC
+    if since.tzinfo is not None:
+        since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return since
+
+
+def export(query):
+    """ Streams every post of `query` as newline delimited JSON, oldest first
+
+    Rows are fetched APP_EXPORT_BATCH_SIZE at a time from a server side cursor, memory stays
+    constant however many rows there are. `?since=<timestamp>` exports only posts
+    written at or after it, a sync resumes from the timestamp of the last line it received.
+    """
+
+    since = _since()
+    if since is not None:
+        query = query.filter(Post.timestamp >= since)
+
+    query = query.order_by(Post.timestamp.asc(), Post.id.asc()) \
+        .yield_per(current_app.config['APP_EXPORT_BATCH_SIZE'])
+
+    fields = requested_fields()
+
+    def generate():
+        for post in query:
+            yield json.dumps(post.to_json(fields)) + '\n'
+
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@api.get('/posts/export')
+def export_posts():
+    return export(Post.query)
+
+
+@api.get('/users/<int:id>/posts/export')
+def export_user_posts(id):
+    user = User.query.get_or_404(id)
+    return export(user.posts)
@@ -0,0 +1,39 @@
+from flask import current_app, request
+from ..exceptions import ValidationError
+
+
+def requested_fields():
+    """ Field names of `?fields=id,body`, None when every field is wanted """
+
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+
+    return { field.strip() for field in fields.split(',') if field.strip() }
+
+
+def page_size(key):
+    """ Items per page of `?per_page=`, the config value `key` when not given
+
+    Capped by APP_API_MAX_PER_PAGE so one request can not load an unbounded page.
+    """
+
+    per_page = request.args.get('per_page')
+    if per_page is None:
+        return current_app.config[key]
+
+    try:
+        per_page = int(per_page)
+    except ValueError:
+        raise ValidationError('per_page has to be an integer')
+
+    if per_page < 1:
+        raise ValidationError('per_page has to be positive')
+
+    return min(per_page, current_app.config['APP_API_MAX_PER_PAGE'])
+
+
+def list_args():
+    """ Arguments of the request the prev and next links of its pages keep """
+
+    return { name: request.args[name] for name in ('per_page', 'fields') if name in request.args }
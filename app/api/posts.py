@@ -4,29 +4,39 @@ from . import api
 from .decorators import permission_required
 from .. import db
 from .errors import forbidden
+from ..pagination import CursorPagination
+from .params import requested_fields, page_size, list_args
+from .batch import requested_ids, get_batch, create_batch
 
 
 @api.get('/posts/')
 def get_posts():
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.paginate(
-        page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-        error_out=False
+    ids = requested_ids()
+    if ids is not None:
+        return get_batch(Post, ids, 'posts')
+
+    pagination = CursorPagination(
+        Post.query, (Post.timestamp, Post.id), request.args.get('cursor'),
+        per_page=page_size('APP_POSTS_PER_PAGE'),
+        count_mode=request.args.get('count', current_app.config['APP_API_COUNT_MODE'])
     )
 
     posts = pagination.items
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_posts', page=page-1)
+        prev = url_for('api.get_posts', cursor=pagination.prev_cursor, **list_args())
 
     next = None
     if pagination.has_next:
-        next = url_for('api.get_posts', page=page+1)
+        next = url_for('api.get_posts', cursor=pagination.next_cursor, **list_args())
 
+    fields = requested_fields()
     return jsonify({
-        'posts': [post.to_json() for post in posts],
+        'posts': [post.to_json(fields) for post in posts],
         'prev': prev,
         'next': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
         'count': pagination.total
     })
 
@@ -34,14 +44,21 @@ def get_posts():
 @api.get('/posts/<int:id>')
 def get_post(id):
     post = Post.query.get_or_404(id)
-    return jsonify(post.to_json())
+    return jsonify(post.to_json(requested_fields()))
 
 
 @api.post('/posts/')
 @permission_required(Permission.WRITE)
 def new_post():
-    post = Post.from_json(request.json)
-    post.author = g.current_user
+    def build(json_post):
+        post = Post.from_json(json_post)
+        post.author = g.current_user
+        return post
+
+    if isinstance(request.json, list):
+        return create_batch(Post, request.json, 'post', 'api.get_post', build)
+
+    post = build(request.json)
     db.session.add(post)
     db.session.commit()
     return jsonify(post.to_json()), 201, { 'Location': url_for('api.get_post', id=post.id) }
@@ -0,0 +1,47 @@
+from flask import jsonify, request, url_for, current_app
+from .. import search as full_text
+from ..models import Post, Comment
+from . import api
+from .errors import bad_request
+from ..pagination import CursorPagination
+from .params import requested_fields, page_size, list_args
+
+
+@api.get('/search')
+def search():
+    """ Matches of `?q=` ordered by relevance, cursors are best effort, see search.search """
+
+    q = request.args.get('q', '')
+    kind = request.args.get('type', 'posts')
+    if kind not in full_text.TABLES:
+        return bad_request(f'type has to be one of: {", ".join(full_text.TABLES)}')
+
+    model, per_page = (Post, 'APP_POSTS_PER_PAGE') if kind == 'posts' else (Comment, 'APP_COMMENTS_PER_PAGE')
+    query, columns = full_text.search(model, q)
+    if model is Comment:
+        query = query.filter(Comment.disabled.isnot(True))
+
+    pagination = CursorPagination(
+        query, columns, request.args.get('cursor'),
+        per_page=page_size(per_page),
+        count_mode=request.args.get('count', current_app.config['APP_API_COUNT_MODE'])
+    )
+
+    results = pagination.items
+    prev = None
+    if pagination.has_prev:
+        prev = url_for('api.search', q=q, type=kind, cursor=pagination.prev_cursor, **list_args())
+
+    next = None
+    if pagination.has_next:
+        next = url_for('api.search', q=q, type=kind, cursor=pagination.next_cursor, **list_args())
+
+    fields = requested_fields()
+    return jsonify({
+        kind: [dict(item.to_json(fields), score=score) for item, score, _ in results],
+        'prev': prev,
+        'next': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
+        'count': pagination.total
+    })
@@ -1,36 +1,41 @@
 from flask import jsonify, request, current_app, url_for
 from . import api
 from ..models import User, Post
+from ..pagination import CursorPagination
+from .params import requested_fields, page_size, list_args
 
 
 @api.get('/users/<int:id>')
 def get_user(id):
     user = User.query.get_or_404(id)
-    return jsonify(user.to_json())
+    return jsonify(user.to_json(requested_fields()))
 
 
 @api.get('/users/<int:id>/posts/')
 def get_user_posts(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-        error_out=False
+    pagination = CursorPagination(
+        user.posts, (Post.timestamp, Post.id), request.args.get('cursor'),
+        per_page=page_size('APP_POSTS_PER_PAGE'),
+        count_mode=request.args.get('count', current_app.config['APP_API_COUNT_MODE'])
     )
 
     posts = pagination.items
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_user_posts', id=id, page=page-1)
+        prev = url_for('api.get_user_posts', id=id, cursor=pagination.prev_cursor, **list_args())
 
     next = None
     if pagination.has_next:
-        next = url_for('api.get_user_posts', id=id, page=page+1)
+        next = url_for('api.get_user_posts', id=id, cursor=pagination.next_cursor, **list_args())
 
+    fields = requested_fields()
     return jsonify({
-        'posts': [post.to_json() for post in posts],
+        'posts': [post.to_json(fields) for post in posts],
         'prev': prev,
         'next': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
         'count': pagination.total
     })
 
@@ -38,24 +43,28 @@ def get_user_posts(id):
 @api.get('/users/<int:id>/timeline/')
 def get_user_followed_posts(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followed_posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-        error_out=False
+    query, columns = user.timeline()
+    pagination = CursorPagination(
+        query, columns, request.args.get('cursor'),
+        per_page=page_size('APP_POSTS_PER_PAGE'),
+        count_mode=request.args.get('count', current_app.config['APP_API_COUNT_MODE'])
     )
 
     posts = pagination.items
     prev = None
     if pagination.has_prev:
-        prev = url_for('api.get_user_followed_posts', id=id, page=page-1)
+        prev = url_for('api.get_user_followed_posts', id=id, cursor=pagination.prev_cursor, **list_args())
 
     next = None
     if pagination.has_next:
-        next = url_for('api.get_user_followed_posts', id=id, page=page+1)
+        next = url_for('api.get_user_followed_posts', id=id, cursor=pagination.next_cursor, **list_args())
 
+    fields = requested_fields()
     return jsonify({
-        'posts': [post.to_json() for post in posts],
+        'posts': [post.to_json(fields) for post in posts],
         'prev': prev,
         'next': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
         'count': pagination.total
     })
@@ -0,0 +1,260 @@
+import asyncio, time
+from flask import current_app, jsonify, request, url_for
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from werkzeug.routing import RequestRedirect
+from . import create_app, db
+from .api.authentication import token_key, credentials_key
+from .api.batch import requested_ids, batch_json
+from .api.params import requested_fields, page_size, list_args
+from .api.errors import bad_request, unauthorized, forbidden
+from .exceptions import ValidationError
+from .identity import snapshot
+from .models import User, Post, Comment
+from .pagination import CursorPagination
+
+
+ASYNC_DRIVERS = { 'mysql': 'mysql+aiomysql', 'sqlite': 'sqlite+aiosqlite' }
+
+
+def async_url(uri):
+    """ `uri` with the blocking driver swapped for the asyncio one of its database """
+
+    url = make_url(uri)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+async def _load_user(session, statement):
+    return (await session.execute(statement.options(db.joinedload(User.role)))).scalars().first()
+
+
+async def verify_token(session, token):
+    """ Identity snapshot of a valid token, async twin of `api.authentication.verify_token` """
+
+    state = current_app.extensions['token_cache']
+    key = token_key(token)
+    identity = state.lookup(key)
+    if identity is not None:
+        return identity
+
+    data = User.decode_auth_token(token)
+    if data is None:
+        return None
+
+    user = await _load_user(session, db.select(User).where(User.id == data['id']))
+    if user is None:
+        return None
+
+    ttl = min(data['exp'] - time.time(), current_app.config['APP_TOKEN_CACHE_TTL'])
+    if ttl > 0:
+        state.set(key, user, ttl=ttl)
+
+    return snapshot(user)
+
+
+async def verify_credentials(session, email, password):
+    """ Identity snapshot of matching credentials, the password hash runs off the event loop """
+
+    user = await _load_user(session, db.select(User).where(User.email == email))
+    if user is None or user.password_hash is None:
+        return None
+
+    state = current_app.extensions['credentials_cache']
+    key = credentials_key(email, password, user.password_hash)
+    if state.get(key) is None:
+        if not await asyncio.to_thread(user.verify_password, password):
+            return None
+
+        state.set(key, True)
+
+    return snapshot(user)
+
+
+def _page(pagination, endpoint, **values):
+    prev = None
+    if pagination.has_prev:
+        prev = url_for(endpoint, cursor=pagination.prev_cursor, **values, **list_args())
+
+    next = None
+    if pagination.has_next:
+        next = url_for(endpoint, cursor=pagination.next_cursor, **values, **list_args())
+
+    return {
+        'prev': prev,
+        'next': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
+        'count': pagination.total
+    }
+
+
+def _json(items):
+    fields = requested_fields()
+    return [item.to_json(fields) for item in items]
+
+
+async def _paginate(session, statement, columns, per_page):
+    return await CursorPagination.execute(
+        session, statement, columns, request.args.get('cursor'),
+        per_page=page_size(per_page),
+        count_mode=request.args.get('count', current_app.config['APP_API_COUNT_MODE'])
+    )
+
+
+async def _get_batch(session, model, key):
+    ids = requested_ids()
+    if ids is None:
+        return None
+
+    rows = (await session.execute(db.select(model).where(model.id.in_(ids)))).scalars() if ids else ()
+    return batch_json(key, ids, rows, requested_fields())
+
+
+class _NotFound(Exception):
+    pass
+
+
+def _not_found():
+    response = jsonify({ 'error': 'not found' })
+    response.status_code = 404
+    return response
+
+
+async def _get_or_404(session, model, id):
+    obj = await session.get(model, id)
+    if obj is None:
+        raise _NotFound()
+
+    return obj
+
+
+async def get_post(session, id):
+    return (await _get_or_404(session, Post, id)).to_json(requested_fields())
+
+
+async def get_posts(session):
+    batch = await _get_batch(session, Post, 'posts')
+    if batch is not None:
+        return batch
+
+    pagination = await _paginate(session, db.select(Post), (Post.timestamp, Post.id), 'APP_POSTS_PER_PAGE')
+    return dict(posts=_json(pagination.items), **_page(pagination, 'api.get_posts'))
+
+
+async def get_user(session, id):
+    return (await _get_or_404(session, User, id)).to_json(requested_fields())
+
+
+async def get_user_posts(session, id):
+    user = await _get_or_404(session, User, id)
+    pagination = await _paginate(session, db.select(Post).where(Post.author_id == user.id),
+                                 (Post.timestamp, Post.id), 'APP_POSTS_PER_PAGE')
+    return dict(posts=_json(pagination.items), **_page(pagination, 'api.get_user_posts', id=id))
+
+
+async def get_user_followed_posts(session, id):
+    user = await _get_or_404(session, User, id)
+    query, columns = user.timeline(await session.scalar(db.select(user.pull_authors().exists())))
+    pagination = await _paginate(session, query.statement, columns, 'APP_POSTS_PER_PAGE')
+    return dict(posts=_json(pagination.items),
+                **_page(pagination, 'api.get_user_followed_posts', id=id))
+
+
+async def get_comments(session):
+    batch = await _get_batch(session, Comment, 'comments')
+    if batch is not None:
+        return batch
+
+    pagination = await _paginate(session, db.select(Comment), (Comment.timestamp, Comment.id), 'APP_COMMENTS_PER_PAGE')
+    return dict(comments=_json(pagination.items), **_page(pagination, 'api.get_comments'))
+
+
+HANDLERS = {
+    'api.get_post': get_post,
+    'api.get_posts': get_posts,
+    'api.get_user': get_user,
+    'api.get_user_posts': get_user_posts,
+    'api.get_user_followed_posts': get_user_followed_posts,
+    'api.get_comments': get_comments
+}
+
+
+class AsyncReadAPI:
+    """ ASGI app serving the read-only API endpoints with SQLAlchemy's asyncio extension
+
+    Requests are matched against the url rules of the Flask `app` and answered inside its
+    request context, with the same models, `to_json` shapes, cursor pagination and
+    authentication caches as the WSGI app. One process keeps up to APP_ASYNC_POOL_SIZE
+    queries in flight instead of one per worker. Every other path is answered with 404,
+    the proxy in front sends writes and html pages to the WSGI workers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        url = async_url(app.config['APP_ASYNC_DATABASE_URI'] or app.config['SQLALCHEMY_DATABASE_URI'])
+        options = {}
+        if url.get_backend_name() != 'sqlite':
+            options.update(pool_size=app.config['APP_ASYNC_POOL_SIZE'], pool_recycle=3600)
+
+        self.engine = create_async_engine(url, **options)
+        self.sessions = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            response = await self._respond(scope)
+            headers = [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in response.headers.items()]
+            await send({ 'type': 'http.response.start', 'status': response.status_code, 'headers': headers })
+            await send({ 'type': 'http.response.body', 'body': response.get_data() })
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({ 'type': 'lifespan.startup.complete' })
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({ 'type': 'lifespan.shutdown.complete' })
+                return
+
+    async def _respond(self, scope):
+        headers = [(key.decode('latin-1'), value.decode('latin-1')) for key, value in scope['headers']]
+        with self.app.test_request_context(scope['path'], method=scope['method'], headers=headers,
+                                           query_string=scope['query_string']):
+            if isinstance(request.routing_exception, RequestRedirect):
+                return request.routing_exception.get_response()
+
+            handler = HANDLERS.get(request.endpoint)
+            if handler is None or request.method != 'GET':
+                return _not_found()
+
+            try:
+                async with self.sessions() as session:
+                    identity = await self._authenticate(session)
+                    if identity is None:
+                        return unauthorized('Invalid credentials')
+                    if not identity['user']['confirmed']:
+                        return forbidden('Unconfirmed account')
+
+                    return jsonify(await handler(session, **request.view_args))
+            except ValidationError as e:
+                return bad_request(e.args[0])
+            except _NotFound:
+                return _not_found()
+
+    @staticmethod
+    async def _authenticate(session):
+        auth = request.authorization
+        if auth is None or not auth.username:
+            return None
+
+        if not auth.password:
+            return await verify_token(session, auth.username)
+
+        return await verify_credentials(session, auth.username, auth.password)
+
+
+def create_asgi_app(config_name):
+    return AsyncReadAPI(create_app(config_name))
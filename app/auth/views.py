@@ -12,12 +12,14 @@ from .forms import (
 )
 from .. import db
 from ..email import send_email
+from ..last_seen import last_seen
+from ..replicas import read_primary
 
 
 @auth.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.ping()
+        last_seen.touch(current_user.id)
         if not current_user.confirmed \
                 and request.endpoint \
                 and request.blueprint != 'auth' \
@@ -75,6 +77,7 @@ def secret():
 
 
 @auth.get('/confirm/<string:token>')
+@read_primary
 @login_required
 def confirm(token):
     if current_user.confirmed:
@@ -174,6 +177,7 @@ def change_email():
 
 
 @auth.get('/confirm-change-email/<string:token>')
+@read_primary
 @login_required
 def confirm_change_email(token):
     if current_user.confirm(token):
@@ -0,0 +1,161 @@
+import json, math, time
+from base64 import b64encode
+from flask import url_for
+from . import db
+from .models import User, Role, Post, Comment
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[max(math.ceil(q * len(values)) - 1, 0)]
+
+
+def targets(app, password='test', echo=print):
+    """ (name, url, headers) of every benchmarked endpoint, pointing at the busiest rows
+
+    API endpoints taking an id of something else than a user, post or comment are skipped.
+    """
+
+    user = User.query.order_by(User.follower_count.desc()).first()
+    post = Post.query.order_by(Post.comment_count.desc()).first()
+    comment = Comment.query.order_by(Comment.id).first()
+    ids = { 'user': user.id, 'post': post.id, 'comment': comment.id }
+    credentials = b64encode(f'{user.email}:{password}'.encode('utf-8')).decode('utf-8')
+    api_headers = { 'Authorization': f'Basic {credentials}', 'Accept': 'application/json' }
+    # Two words of the busiest post, searches match it and whatever shares a word
+    query = ' '.join(post.body.split()[:2])
+
+    with app.test_request_context():
+        urls = [
+            ('main.index', url_for('main.index'), {}),
+            ('main.user', url_for('main.user', username=user.username), {}),
+            ('main.post', url_for('main.post', id=post.id), {}),
+            ('main.followers', url_for('main.followers', username=user.username), {}),
+            ('main.followed_by', url_for('main.followed_by', username=user.username), {}),
+            ('main.search', url_for('main.search', q=query), {})
+        ]
+
+        for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.endpoint):
+            if not rule.endpoint.startswith('api.') or 'GET' not in rule.methods:
+                continue
+
+            if rule.endpoint == 'api.search':
+                urls.append((rule.endpoint, url_for(rule.endpoint, q=query), api_headers))
+                continue
+
+            values = {}
+            if rule.arguments:
+                # /users/<id>/posts/ takes a user id, /posts/<id>/comments/ a post id
+                kind = next((kind for kind in ids if kind in rule.endpoint), None)
+                if kind is None or rule.arguments != { 'id' }:
+                    echo(f'Skipping {rule.endpoint}, no row to point {rule.rule} at')
+                    continue
+
+                values = { 'id': ids[kind] }
+
+            urls.append((rule.endpoint, url_for(rule.endpoint, **values), api_headers))
+
+    return urls
+
+
+def run(app, urls, requests=100, warmup=10, echo=print):
+    """ Drives every url through the WSGI app, returns latency percentiles in ms,
+    requests per second and SQL statements per request of each endpoint """
+
+    client = app.test_client()
+    statements = 0
+    def before_cursor_execute(*args):
+        nonlocal statements
+        statements += 1
+
+    results = {}
+    db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        for name, url, headers in urls:
+            for _ in range(warmup):
+                client.get(url, headers=headers)
+
+            statements = 0
+            latencies = []
+            for _ in range(requests):
+                start = time.perf_counter()
+                response = client.get(url, headers=headers)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    raise RuntimeError(f'{url} returned {response.status_code}')
+
+            results[name] = {
+                'rps': round(requests / sum(latencies), 1),
+                'p50': round(_percentile(latencies, 0.50) * 1000, 2),
+                'p95': round(_percentile(latencies, 0.95) * 1000, 2),
+                'p99': round(_percentile(latencies, 0.99) * 1000, 2),
+                'queries': round(statements / requests, 2)
+            }
+            echo(f'{name:32} {results[name]["rps"]:>8} req/s  p50 {results[name]["p50"]:>7} ms  '
+                 f'p95 {results[name]["p95"]:>7} ms  p99 {results[name]["p99"]:>7} ms  '
+                 f'{results[name]["queries"]:>5} queries')
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """ Regressions of `results` against `baseline`, latency and throughput may drift by
+    `tolerance`, the number of queries per request may not grow at all """
+
+    regressions = []
+    for name, base in sorted(baseline.items()):
+        current = results.get(name)
+        if current is None:
+            continue
+
+        if current['p95'] > base['p95'] * (1 + tolerance):
+            regressions.append(f'{name}: p95 {current["p95"]} ms, baseline {base["p95"]} ms')
+        if current['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f'{name}: {current["rps"]} req/s, baseline {base["rps"]} req/s')
+        if current['queries'] > base['queries']:
+            regressions.append(f'{name}: {current["queries"]} queries per request, baseline {base["queries"]}')
+
+    return regressions
+
+
+def bench(app, users=200, posts=2000, comments=4000, follows=20, seed=0, password='test', requests=100,
+          warmup=10, baseline=None, save_baseline=False, tolerance=0.2, echo=print):
+    """ Benchmarks `app`, seeding its database first when it has no users
+
+    Tables created for the run are dropped afterwards, existing tables are never dropped.
+    API requests log in as the most followed user with `password`. Returns the regressions
+    against the `baseline` file, or writes the results to it with `save_baseline`.
+    """
+
+    from .fake import seed as seed_data
+
+    with app.app_context():
+        inspector = db.inspect(db.engine)
+        created = [table for table in db.Model.metadata.sorted_tables if not inspector.has_table(table.name)]
+        if created:
+            db.Model.metadata.create_all(bind=db.engine, tables=created)
+
+        if User.query.first() is None:
+            Role.insert_roles()
+            seed_data(users=users, posts=posts, comments=comments, follows=follows, seed=seed,
+                      password=password, echo=echo)
+
+        try:
+            results = run(app, targets(app, password, echo), requests=requests, warmup=warmup, echo=echo)
+        finally:
+            if created:
+                db.session.remove()
+                db.Model.metadata.drop_all(bind=db.engine, tables=created)
+
+    if baseline and save_baseline:
+        with open(baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return []
+
+    if baseline:
+        with open(baseline) as f:
+            return compare(results, json.load(f), tolerance)
+
+    return []
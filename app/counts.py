@@ -0,0 +1,146 @@
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy.sql.util import find_tables
+from . import db
+from .cache import TTLCache
+from .exceptions import ValidationError
+
+
+COUNT_MODES = ('exact', 'estimate', 'none')
+
+
+def validate_mode(mode):
+    if mode not in COUNT_MODES:
+        raise ValidationError(f'count has to be one of: {", ".join(COUNT_MODES)}')
+
+
+def _key(statement, url):
+    compiled = statement.compile()
+    return str(compiled), tuple(sorted(compiled.params.items())), url
+
+
+def _tables(statement):
+    return { table.name for table in find_tables(statement, include_aliases=True, include_joins=True) }
+
+
+class _CountState:
+    def __init__(self, maxsize, ttl):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Every insert or delete bumps the generation of its table, cached
+        # counts computed under an older generation are stale
+        self.generations = defaultdict(int)
+
+    def invalidate(self, tables):
+        for table in tables:
+            self.generations[table] += 1
+
+
+class CountCache:
+    """ Caches `COUNT(*)` of paginated queries with a TTL and per-table invalidation
+
+    The cache and its generations live in each worker process, inserts and deletes made
+    by another worker go unnoticed until APP_COUNT_CACHE_TTL expires the cached count.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['count_cache'] = _CountState(app.config['APP_COUNT_CACHE_SIZE'], app.config['APP_COUNT_CACHE_TTL'])
+
+    @property
+    def state(self) -> _CountState:
+        return current_app.extensions['count_cache']
+
+    def count(self, query, mode='exact'):
+        """ Returns (count, is_estimate), `estimate` accepts stale cached counts or table statistics """
+
+        validate_mode(mode)
+        if mode == 'none':
+            return None, False
+
+        query = query.order_by(None)
+        statement = query.statement
+        # Replicas may lag behind the primary, counts of every database are cached apart
+        url = str(query.session.get_bind(clause=statement).url)
+        cached = self.lookup(statement, url, mode)
+        if cached is not None:
+            return cached
+
+        tables = _tables(statement)
+        if mode == 'estimate' and statement.whereclause is None and len(tables) == 1:
+            value = self._table_estimate(query, next(iter(tables)))
+            if value is not None:
+                return value, True
+
+        value = query.count()
+        self.store(statement, url, value)
+        return value, False
+
+    def lookup(self, statement, url, mode='exact'):
+        """ Cached (count, is_estimate) of `statement` on the database at `url`, None on a miss """
+
+        state = self.state
+        entry = state.entries.get(_key(statement, url))
+        if entry is None:
+            return None
+
+        value, generations = entry
+        if mode == 'estimate' or all(state.generations[table] == generation for table, generation in generations.items()):
+            return value, mode == 'estimate'
+
+        return None
+
+    def store(self, statement, url, value):
+        state = self.state
+        generations = { table: state.generations[table] for table in _tables(statement) }
+        state.entries.set(_key(statement, url), (value, generations))
+
+    def _table_estimate(self, query, table):
+        connection = query.session.connection()
+        if connection.dialect.name != 'mysql':
+            return None
+
+        return connection.execute(
+            db.text('SELECT TABLE_ROWS FROM information_schema.TABLES '
+                    'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table'),
+            { 'table': table }
+        ).scalar()
+
+
+count_cache = CountCache()
+
+
+def changed(session, *tables):
+    """ Marks `tables` as written by Core statements, the flush only sees ORM inserts and deletes """
+
+    session.info.setdefault('count_tables', set()).update(tables)
+
+
+def _changed_tables(session):
+    return { obj.__table__.name for obj in list(session.new) + list(session.deleted) if hasattr(obj, '__table__') }
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def before_flush(session, flush_context, instances):
+    session.info.setdefault('count_tables', set()).update(_changed_tables(session))
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def after_flush(session, flush_context):
+    # The flushing session sees its own rows right away, other sessions only after the commit
+    if 'count_cache' in current_app.extensions:
+        current_app.extensions['count_cache'].invalidate(session.info.get('count_tables', ()))
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def after_commit(session):
+    tables = session.info.pop('count_tables', ())
+    if 'count_cache' in current_app.extensions:
+        current_app.extensions['count_cache'].invalidate(tables)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def after_rollback(session):
+    session.info.pop('count_tables', None)
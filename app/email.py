@@ -1,15 +1,174 @@
-from flask import Flask, render_template, current_app
+import atexit, queue, smtplib, threading, time
+from flask import render_template, current_app
 from flask_mail import Message
 from . import mail
-from threading import Thread
 
 
-def send_async_email(app: Flask, msg: Message) -> None:
-    with app.app_context():
-        mail.send(msg)
+class _MailState:
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config['APP_MAIL_WORKERS']
+        self.batch_size = app.config['APP_MAIL_BATCH_SIZE']
+        self.max_retries = app.config['APP_MAIL_MAX_RETRIES']
+        self.backoff = app.config['APP_MAIL_RETRY_BACKOFF']
+        self.idle_timeout = app.config['APP_MAIL_IDLE_TIMEOUT']
+        self.queue = queue.Queue()
+        self.threads = set()
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        # Queued, in flight and waiting for a retry
+        self.pending = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.started = time.monotonic()
 
+    def put(self, msg, attempts=0, new=True):
+        with self.lock:
+            if new:
+                self.pending += 1
+            self.queue.put((msg, attempts))
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='mail-worker', daemon=True)
+                self.threads.add(thread)
+                thread.start()
 
-def send_email(to: str, subject: str, template: str, **kwargs) -> Thread:
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.idle_timeout)]
+        except queue.Empty:
+            return None
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _work(self):
+        connection = None
+        with self.app.app_context():
+            try:
+                while True:
+                    batch = self._next_batch()
+                    if batch is None:
+                        with self.lock:
+                            # Checked under the lock so a message put meanwhile still finds a worker
+                            if self.queue.empty():
+                                self.threads.discard(threading.current_thread())
+                                return
+                        continue
+
+                    for msg, attempts in batch:
+                        try:
+                            if connection is None:
+                                # Assigned once open, flask_mail can not close a connection that never opened
+                                opened = mail.connect()
+                                opened.__enter__()
+                                connection = opened
+                            connection.send(msg)
+                        except (smtplib.SMTPException, OSError):
+                            connection = self._close(connection)
+                            self._retry(msg, attempts)
+                        else:
+                            self._finish(sent=True)
+            finally:
+                with self.lock:
+                    self.threads.discard(threading.current_thread())
+                self._close(connection)
+
+    def _close(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError, AttributeError):
+                pass
+
+        return None
+
+    def _retry(self, msg, attempts):
+        if attempts >= self.max_retries:
+            self.app.logger.exception(f'Could not send mail to {", ".join(msg.recipients)}')
+            self._finish(sent=False)
+            return
+
+        with self.lock:
+            self.retried += 1
+
+        timer = threading.Timer(self.backoff * 2 ** attempts, self.put, (msg, attempts + 1, False))
+        timer.daemon = True
+        timer.start()
+
+    def _finish(self, sent):
+        with self.lock:
+            if sent:
+                self.sent += 1
+            else:
+                self.failed += 1
+
+            self.pending -= 1
+            self.done.notify_all()
+
+    def flush(self, timeout=None):
+        """ Waits until every queued message was sent or given up, returns False on timeout """
+
+        with self.lock:
+            return self.done.wait_for(lambda: self.pending == 0, timeout)
+
+    def flush_at_exit(self):
+        if not self.flush(self.app.config['APP_MAIL_FLUSH_TIMEOUT']):
+            self.app.logger.error(f'{self.pending} mails were not sent before exit')
+
+    def stats(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            return {
+                'depth': self.pending,
+                'workers': len(self.threads),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'per_second': self.sent / elapsed if elapsed > 0 else 0.0
+            }
+
+
+class MailQueue:
+    """ Outbound mail drained by at most APP_MAIL_WORKERS threads
+
+    Every worker keeps its SMTP connection open while there is mail to send and sends
+    up to APP_MAIL_BATCH_SIZE messages per wakeup. Failed messages are retried with
+    exponential backoff. Workers exit when idle, and pending mail is flushed when the
+    process exits.
+
+    The queue lives in memory only: mail still queued or waiting for a retry is lost when
+    the process is killed or APP_MAIL_FLUSH_TIMEOUT runs out at exit.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        state = _MailState(app)
+        app.extensions['mail_queue'] = state
+        atexit.register(state.flush_at_exit)
+
+    def put(self, msg: Message) -> None:
+        current_app.extensions['mail_queue'].put(msg)
+
+    def flush(self, timeout=None) -> bool:
+        return current_app.extensions['mail_queue'].flush(timeout)
+
+    def stats(self):
+        return current_app.extensions['mail_queue'].stats()
+
+
+mail_queue = MailQueue()
+
+
+def send_email(to: str, subject: str, template: str, **kwargs) -> Message:
     """ Function to sending mails """
 
     app = current_app._get_current_object()
@@ -17,6 +176,5 @@ def send_email(to: str, subject: str, template: str, **kwargs) -> Thread:
                   sender=app.config['APP_MAIL_SENDER'], recipients=[to])
     msg.body = render_template(template + '.txt', **kwargs)
     msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    mail_queue.put(msg)
+    return msg
@@ -1,40 +1,216 @@
-from random import randint
-from sqlalchemy.exc import IntegrityError
+import hashlib, os
+from array import array
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from random import Random, randrange
 from faker import Faker
 from . import db
-from .models import User, Post
+from .models import User, Role, Post, Comment, Follow
+from .render import render_html, POST_ALLOWED_TAGS, COMMENT_ALLOWED_TAGS
+from .hashing import hasher
+from . import search
 
 
-def users(count=100):
-    fake = Faker()
-    i = 0
-    while i < count:
-        u = User(
-            email=fake.email(),
-            username=fake.user_name(),
-            password='test',
-            confirmed=True,
-            name=fake.name(),
-            location=fake.city(),
-            about_me=fake.text(),
-            member_since=fake.past_date()
-        )
-
-        db.session.add(u)
-
-        try:
-            db.session.commit()
-            i += 1
-        except IntegrityError:
-            db.session.rollback()
+# Timestamps of generated rows are spread over this period before `until`
+SPAN = timedelta(days=2 * 365)
 
+# Rendering markdown dominates generation, bodies are joined from a pool of
+# paragraphs rendered once per chunk, the html of plain paragraphs composes
+PARAGRAPHS = 200
 
-def posts(count=100):
+# Ids referenced by generated rows, set once in every worker process
+_ids = {}
+
+
+def _init_worker(ids):
+    _ids.update(ids)
+
+
+def _generators(seed, table, index):
+    """ Random and Faker instances that depend only on the seed and the chunk """
+
+    name = f'{seed}:{table}:{index}'
     fake = Faker()
-    user_count = User.query.count()
-    for i in range(count):
-        u = User.query.offset(randint(0, user_count - 1)).first()
-        p = Post(body=fake.text(), timestamp=fake.past_date(), author=u)
-        db.session.add(p)
+    fake.seed_instance(name)
+    return Random(name), fake
+
+
+def _popular(rng, ids):
+    """ Picks from `ids` with a Zipf-like distribution, the first ids are the most popular """
+
+    return ids[int((len(ids) + 1) ** rng.random()) - 1]
+
+
+def _paragraphs(fake, allowed_tags):
+    paragraphs = [fake.paragraph() for _ in range(PARAGRAPHS)]
+    return [(paragraph, render_html(paragraph, allowed_tags)) for paragraph in paragraphs]
+
+
+def _timestamp(rng, until):
+    return until - timedelta(seconds=rng.randrange(int(SPAN.total_seconds())))
+
+
+def _user_rows(args):
+    seed, index, ids, context = args
+    rng, fake = _generators(seed, 'users', index)
+    rows = []
+    for id in ids:
+        email = f'{fake.user_name()}{id}@{fake.free_email_domain()}'
+        member_since = _timestamp(rng, context['until'])
+        rows.append({
+            'id': id,
+            'email': email,
+            'username': f'{fake.user_name()}{id}',
+            'password_hash': context['password_hash'],
+            'confirmed': True,
+            'role_id': context['role_id'],
+            'name': fake.name(),
+            'location': fake.city(),
+            'about_me': fake.text(),
+            'member_since': member_since,
+            'last_seen': member_since,
+            'avatar_hash': hashlib.md5(email.lower().encode('utf-8')).hexdigest()
+        })
+
+    return rows
+
+
+def _follow_rows(args):
+    seed, index, ids, context = args
+    rng, _ = _generators(seed, 'follows', index)
+    users = _ids['users']
+    rows = []
+    for follower_id in ids:
+        # Every user follows itself, the out-degree follows a Pareto distribution with the
+        # requested mean and targets are picked by popularity so in-degree is heavy tailed too
+        degree = min(int(context['mean'] / 3 * rng.paretovariate(1.5)), len(users) // 2)
+        followed = { follower_id }
+        for _ in range(degree * 4):
+            if len(followed) > degree:
+                break
+            followed.add(_popular(rng, users))
+
+        rows += [{ 'follower_id': follower_id, 'followed_id': followed_id, 'timestamp': _timestamp(rng, context['until']) }
+                 for followed_id in sorted(followed)]
+
+    return rows
+
+
+def _post_rows(args):
+    seed, index, ids, context = args
+    rng, fake = _generators(seed, 'posts', index)
+    paragraphs = _paragraphs(fake, POST_ALLOWED_TAGS)
+    rows = []
+    for id in ids:
+        picked = rng.sample(paragraphs, rng.randint(1, 3))
+        rows.append({
+            'id': id,
+            'body': '\n\n'.join(body for body, _ in picked),
+            'body_html': '\n'.join(html for _, html in picked),
+            'timestamp': _timestamp(rng, context['until']),
+            'author_id': _popular(rng, _ids['users'])
+        })
 
+    return rows
+
+
+def _comment_rows(args):
+    seed, index, ids, context = args
+    rng, fake = _generators(seed, 'comments', index)
+    paragraphs = _paragraphs(fake, COMMENT_ALLOWED_TAGS)
+    users = _ids['users']
+    rows = []
+    for id in ids:
+        body, html = rng.choice(paragraphs)
+        rows.append({
+            'id': id,
+            'body': body,
+            'body_html': html,
+            'timestamp': _timestamp(rng, context['until']),
+            'disabled': False,
+            'author_id': users[rng.randrange(len(users))],
+            'post_id': _popular(rng, _ids['posts'])
+        })
+
+    return rows
+
+
+def _next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def _existing_ids(model):
+    return array('q', (id for id, in db.session.query(model.id).order_by(model.id).yield_per(10000)))
+
+
+def seed(users=1000, posts=10000, comments=20000, follows=20, seed=None, password='test',
+         until=None, chunk_size=10000, processes=None, echo=print):
+    """ Bulk insert a generated dataset on top of the existing rows
+
+    Rows are generated in chunks of `chunk_size` across a process pool and inserted with
+    one executemany per chunk. A chunk only depends on `seed`, its position and `until`,
+    so the same arguments produce the same rows. Every user shares one pre-hashed
+    `password`. Follows and comments are picked with a power-law popularity, `follows` is
+    the mean number of users followed. Counters, timelines and the search index are
+    rebuilt at the end.
+    """
+
+    seed = randrange(2 ** 32) if seed is None else seed
+    until = until or datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    context = {
+        'until': until,
+        'password_hash': hasher.generate(password),
+        'role_id': Role.query.filter_by(default=True).first().id,
+        'mean': follows
+    }
+
+    first_user_id = _next_id(User)
+    new_users = range(first_user_id, first_user_id + users)
+    first_post_id = _next_id(Post)
+    new_posts = range(first_post_id, first_post_id + posts)
+    first_comment_id = _next_id(Comment)
+    new_comments = range(first_comment_id, first_comment_id + comments)
+
+    ids = {
+        'users': _existing_ids(User) + array('q', new_users),
+        'posts': new_posts if posts else _existing_ids(Post)
+    }
+    if not ids['users'] or (comments and not ids['posts']):
+        raise ValueError('Nothing to attach the generated rows to')
+
+    steps = (
+        (User, _user_rows, new_users),
+        (Follow, _follow_rows, new_users),
+        (Post, _post_rows, new_posts),
+        (Comment, _comment_rows, new_comments)
+    )
+
+    with Pool(processes or os.cpu_count(), initializer=_init_worker, initargs=(ids,)) as pool:
+        for model, generate, rows_ids in steps:
+            table = model.__table__
+            chunks = [(seed, index, rows_ids[start:start + chunk_size], context)
+                      for index, start in enumerate(range(0, len(rows_ids), chunk_size))]
+            done = 0
+            for rows in pool.imap(generate, chunks):
+                if rows:
+                    db.session.execute(table.insert(), rows)
+                    db.session.commit()
+
+                done += len(rows)
+                echo(f'{table.name}: {done}')
+
+    echo('Rebuilding counters, timelines and the search index')
+    User.recount_counters()
+    Post.recount_counters()
+    User.rebuild_timelines()
+    search.rebuild()
     db.session.commit()
+    return seed
+
+
+def users(count=100):
+    seed(users=count, posts=0, comments=0)
+
+
+def posts(count=100):
+    seed(users=0, posts=count, comments=0, follows=0)
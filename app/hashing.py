@@ -0,0 +1,124 @@
+import os, threading, time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from flask import current_app, has_app_context
+from werkzeug import security
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class _HashingState:
+    def __init__(self, app):
+        self.processes = app.config['APP_HASHING_PROCESSES']
+        self.timeout = app.config['APP_HASHING_TIMEOUT']
+        # Hashes running in the pool plus the ones waiting for a free process
+        self.slots = threading.BoundedSemaphore(max(self.processes + app.config['APP_HASHING_QUEUE_SIZE'], 1))
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.calls = 0
+        self.rejected = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def _executor(self):
+        with self.lock:
+            # A pool created before gunicorn forked the worker can not be used by it
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ProcessPoolExecutor(max_workers=self.processes)
+                self.pid = os.getpid()
+
+            return self.executor
+
+    def run(self, fn, *args):
+        if self.processes == 0:
+            return self._timed(fn, *args)
+
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise ServiceUnavailable('Too many password checks in progress, try again later')
+
+        with self.lock:
+            self.depth += 1
+
+        released = False
+        def release(future=None):
+            nonlocal released
+            with self.lock:
+                if released:
+                    return
+                released = True
+                self.depth -= 1
+            self.slots.release()
+
+        try:
+            future = self._executor().submit(fn, *args)
+        except BaseException:
+            release()
+            raise
+
+        # A timed out hash keeps its slot until the pool finished or dropped it
+        future.add_done_callback(release)
+        try:
+            return self._timed(future.result, self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise ServiceUnavailable('Password check timed out, try again later')
+        finally:
+            if future.done():
+                release()
+
+    def _timed(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.calls += 1
+                self.seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'processes': self.processes,
+                'depth': self.depth,
+                'calls': self.calls,
+                'rejected': self.rejected,
+                'seconds': self.seconds,
+                'max_seconds': self.max_seconds
+            }
+
+
+class PasswordHasher:
+    """ Runs password hashing in a process pool so request threads only wait for the result
+
+    At most APP_HASHING_PROCESSES + APP_HASHING_QUEUE_SIZE hashes are in flight, any
+    further request gets a 503 right away. APP_HASHING_PROCESSES = 0 hashes inline.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['hashing'] = _HashingState(app)
+
+    def _run(self, fn, *args):
+        if not has_app_context() or 'hashing' not in current_app.extensions:
+            return fn(*args)
+
+        return current_app.extensions['hashing'].run(fn, *args)
+
+    def generate(self, password: str) -> str:
+        return self._run(security.generate_password_hash, password)
+
+    def check(self, password_hash: str, password: str) -> bool:
+        return self._run(security.check_password_hash, password_hash, password)
+
+    def stats(self):
+        return current_app.extensions['hashing'].stats()
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,125 @@
+from blinker import Namespace
+from flask import current_app
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from . import db
+from .cache import TTLCache
+
+
+signals = Namespace()
+
+# Sent after a commit changed identity columns or the password of users, with
+# `user_ids` set to the changed ids or None when every user may be affected
+identity_changed = signals.signal('identity-changed')
+
+USER_COLUMNS = ('id', 'username', 'email', 'confirmed', 'role_id', 'avatar_hash')
+ROLE_COLUMNS = ('id', 'name', 'default', 'permissions')
+
+
+def snapshot(user):
+    """ Plain data of the columns needed to authorize a request, safe to share between sessions """
+
+    role = user.role
+    return {
+        'user': { column: getattr(user, column) for column in USER_COLUMNS },
+        'role': { column: getattr(role, column) for column in ROLE_COLUMNS } if role is not None else None
+    }
+
+
+def _detached(model, values):
+    obj = model.__mapper__.class_manager.new_instance()
+    for column, value in values.items():
+        set_committed_value(obj, column, value)
+
+    make_transient_to_detached(obj)
+    return obj
+
+
+def restore(data):
+    """ Attach a user rebuilt from a snapshot to the current session without a query
+
+    Columns missing from the snapshot are loaded on first access.
+    """
+
+    from .models import User, Role
+
+    user = _detached(User, data['user'])
+    set_committed_value(user, 'role', _detached(Role, data['role']) if data['role'] is not None else None)
+    return db.session.merge(user, load=False)
+
+
+class IdentityCache:
+    """ In-process, TTL bounded cache of user snapshots used by the Flask-Login user loader """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['identity_cache'] = TTLCache(maxsize=app.config['APP_IDENTITY_CACHE_SIZE'],
+                                                    ttl=app.config['APP_IDENTITY_CACHE_TTL'])
+
+    @property
+    def entries(self) -> TTLCache:
+        return current_app.extensions['identity_cache']
+
+    def get(self, user_id):
+        data = self.entries.get(user_id)
+        return restore(data) if data is not None else None
+
+    def set(self, user):
+        self.entries.set(user.id, snapshot(user))
+
+    def invalidate(self, user_ids=None):
+        if user_ids is None:
+            self.entries.clear()
+        else:
+            for user_id in user_ids:
+                self.entries.delete(user_id)
+
+
+identity_cache = IdentityCache()
+
+
+def _changed_identities(session):
+    from .models import User, Role
+
+    user_ids, all_users = set(), False
+    dirty = [obj for obj in session.dirty if session.is_modified(obj, include_collections=False)]
+    for obj in dirty + list(session.deleted):
+        if isinstance(obj, Role):
+            all_users = True
+        elif isinstance(obj, User):
+            state = db.inspect(obj)
+            if obj in session.deleted or any(state.attrs[column].history.has_changes()
+                                             for column in USER_COLUMNS + ('password_hash',)):
+                user_ids.add(obj.id)
+
+    return user_ids, all_users
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def before_flush(session, flush_context, instances):
+    user_ids, all_users = _changed_identities(session)
+    session.info.setdefault('identity_user_ids', set()).update(user_ids)
+    session.info['identity_all_users'] = session.info.get('identity_all_users', False) or all_users
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def after_commit(session):
+    user_ids = session.info.pop('identity_user_ids', set())
+    all_users = session.info.pop('identity_all_users', False)
+    if not user_ids and not all_users:
+        return
+
+    user_ids = None if all_users else user_ids
+    if 'identity_cache' in current_app.extensions:
+        identity_cache.invalidate(user_ids)
+
+    identity_changed.send(current_app._get_current_object(), user_ids=user_ids)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def after_rollback(session):
+    session.info.pop('identity_user_ids', None)
+    session.info.pop('identity_all_users', None)
@@ -0,0 +1,110 @@
+import json, threading
+from collections import defaultdict
+from sqlalchemy.exc import DBAPIError
+from . import db
+
+
+_lock = threading.Lock()
+# Statements already written to the query log by this process
+_logged = set()
+
+
+def record(path, queries):
+    """ Appends statements of `get_debug_queries` not seen yet to the query log """
+
+    lines = []
+    with _lock:
+        for query in queries:
+            if not query.statement.lstrip().upper().startswith('SELECT') or query.statement in _logged:
+                continue
+
+            _logged.add(query.statement)
+            lines.append(json.dumps({ 'statement': query.statement, 'parameters': query.parameters,
+                                      'context': query.context }, default=str))
+
+        if lines:
+            with open(path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+
+
+def load(path):
+    statements = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                statements.setdefault(entry['statement'], entry)
+
+    return list(statements.values())
+
+
+def _mysql_problems(connection, statement, parameters):
+    problems = []
+    for row in connection.exec_driver_sql('EXPLAIN ' + statement, parameters).mappings():
+        extra = row.get('Extra') or ''
+        if row['type'] == 'ALL':
+            problems.append(('full scan', row['table'], f'~{row["rows"]} rows'))
+        elif row['type'] == 'index':
+            problems.append(('full index scan', row['table'], row['key']))
+        if 'Using filesort' in extra:
+            problems.append(('filesort', row['table'], extra))
+        if 'Using temporary' in extra:
+            problems.append(('temporary table', row['table'], extra))
+
+    return problems
+
+
+def _sqlite_problems(connection, statement, parameters):
+    problems = []
+    for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters):
+        detail = row[-1]
+        # "SCAN posts USING INDEX ...", older versions say "SCAN TABLE posts"
+        words = [word for word in detail.split() if word != 'TABLE']
+        if words[0] == 'SCAN' and words[1] != 'CONSTANT':
+            if 'INDEX' not in words:
+                problems.append(('full scan', words[1], detail))
+            elif 'COVERING' not in words:
+                problems.append(('full index scan', words[1], detail))
+        if 'TEMP B-TREE' in detail:
+            problems.append(('filesort', '', detail))
+
+    return problems
+
+
+def advise(path, echo=print):
+    """ Runs EXPLAIN on every logged statement, reports full scans and sorts without an index
+
+    Returns the number of statements with problems.
+    """
+
+    explain = { 'mysql': _mysql_problems, 'sqlite': _sqlite_problems }.get(db.engine.dialect.name)
+    if explain is None:
+        raise RuntimeError(f'EXPLAIN output of {db.engine.dialect.name} is not supported')
+
+    by_table = defaultdict(int)
+    flagged = 0
+    with db.engine.connect() as connection:
+        for entry in load(path):
+            parameters = entry['parameters']
+            parameters = tuple(parameters) if isinstance(parameters, list) else parameters
+            try:
+                problems = explain(connection, entry['statement'], parameters)
+            except DBAPIError as e:
+                echo(f'Could not explain ({e.orig}):\n  {entry["statement"]}\n')
+                continue
+
+            if not problems:
+                continue
+
+            flagged += 1
+            echo(entry['statement'])
+            echo(f'  from {entry["context"]}')
+            for kind, table, detail in problems:
+                by_table[(table, kind)] += 1
+                echo(f'  {kind}: {table} {detail}')
+            echo('')
+
+    for (table, kind), count in sorted(by_table.items(), key=lambda item: -item[1]):
+        echo(f'{count:>5} statements with {kind} on {table or "sort"}')
+
+    return flagged
@@ -0,0 +1,81 @@
+import atexit, datetime, threading, time
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+from . import db
+
+
+class _LastSeenState:
+    def __init__(self, app):
+        self.app = app
+        self.pending = {}
+        self.accepted = {}
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def touch(self, user_id):
+        config = self.app.config
+        now = time.monotonic()
+        with self.lock:
+            accepted = self.accepted.get(user_id)
+            if accepted is not None and now - accepted < config['APP_LAST_SEEN_INTERVAL']:
+                return
+
+            self.accepted[user_id] = now
+            self.pending[user_id] = datetime.datetime.utcnow()
+            due = len(self.pending) >= config['APP_LAST_SEEN_BATCH_SIZE'] \
+                or now - self.last_flush >= config['APP_LAST_SEEN_FLUSH_INTERVAL']
+
+        if due:
+            self.flush()
+
+    def flush_at_exit(self):
+        try:
+            self.flush()
+        except SQLAlchemyError:
+            self.app.logger.exception('Could not flush buffered last_seen updates')
+
+    def flush(self):
+        from .models import User
+
+        now = time.monotonic()
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = now
+            interval = self.app.config['APP_LAST_SEEN_INTERVAL']
+            self.accepted = { id: t for id, t in self.accepted.items() if now - t < interval }
+
+        if not pending:
+            return
+
+        # One UPDATE ... SET last_seen = CASE id WHEN ... END for the whole batch,
+        # on its own connection so it never commits the request session
+        with db.get_engine(self.app).begin() as connection:
+            connection.execute(User.__table__.update()
+                               .where(User.id.in_(pending))
+                               .values(last_seen=db.case(pending, value=User.id)))
+
+        # Core updates are not seen by the session events, drop the cached profiles here
+        if 'page_cache' in self.app.extensions:
+            self.app.extensions['page_cache'].invalidate({ f'users:{id}' for id in pending })
+
+
+class LastSeenBuffer:
+    """ Write-behind buffer for `User.last_seen`, flushed in batches and when the worker exits """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        state = _LastSeenState(app)
+        app.extensions['last_seen'] = state
+        atexit.register(state.flush_at_exit)
+
+    def touch(self, user_id):
+        current_app.extensions['last_seen'].touch(user_id)
+
+    def flush(self):
+        current_app.extensions['last_seen'].flush()
+
+
+last_seen = LastSeenBuffer()
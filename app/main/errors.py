@@ -1,5 +1,16 @@
-from flask import render_template, jsonify, request
+from flask import render_template, jsonify, make_response, request
 from . import main
+from ..exceptions import ValidationError
+
+
+@main.errorhandler(ValidationError)
+def bad_request(e):
+    if request.accept_mimetypes.accept_json and not request.accept_mimetypes.accept_html:
+        response = jsonify({ 'error': 'bad request', 'message': e.args[0] })
+        response.status_code = 400
+        return response
+
+    return e.args[0], 400
 
 
 @main.app_errorhandler(403)
@@ -30,3 +41,15 @@ def internal_server_error(e):
         return response
 
     return render_template('500.html'), 500
+
+
+@main.app_errorhandler(503)
+def service_unavailable(e):
+    if request.accept_mimetypes.accept_json and not request.accept_mimetypes.accept_html:
+        response = jsonify({ 'error': 'service unavailable', 'message': e.description })
+    else:
+        response = make_response(e.description)
+
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
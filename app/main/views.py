@@ -1,3 +1,4 @@
+import pstats
 from flask import (
     render_template,
     flash, redirect,
@@ -5,19 +6,26 @@ from flask import (
     abort,
     current_app,
     request,
-    make_response
+    make_response,
+    send_file
 )
 
 from . import main
-from .. import db
-from ..models import Permission, User, Post, Comment
+from .. import db, index_advisor, search as full_text
+from ..models import Permission, User, Post, Comment, Follow
 from flask_login import login_required, current_user
 from .forms import EditProfileAdminForm, EditProfileForm, PostForm, CommentForm
 from ..decorators import admin_required, permission_required
+from ..pagination import CursorPagination, last_page_cursor
+from ..page_cache import page_cache
+from ..replicas import read_primary
+from ..profiling import collapse
+from ..exceptions import ValidationError
 from flask_sqlalchemy import get_debug_queries
 
 # Index endpoint
 @main.route('/', methods=['GET', 'POST'])
+@page_cache.cached(tags=('posts',))
 def index():
     form = PostForm()
     if current_user.can(Permission.WRITE) and form.validate_on_submit():
@@ -26,19 +34,19 @@ def index():
         db.session.commit()
         return redirect(url_for('.index'))
 
-    page = request.args.get('page', 1, type=int)
     show_followed = False
     if current_user.is_authenticated:
         show_followed = bool(request.cookies.get('show_followed', ''))
 
     if show_followed:
-        query = current_user.followed_posts
+        query, columns = current_user.timeline()
     else:
-        query = Post.query
+        query, columns = Post.query, (Post.timestamp, Post.id)
 
-    pagination = query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['APP_POSTS_PER_PAGE'],
-        error_out=False
+    pagination = CursorPagination(
+        query.options(db.joinedload(Post.author)), columns, request.args.get('cursor'),
+        per_page=current_app.config['APP_POSTS_PER_PAGE'],
+        count_mode=current_app.config['APP_PAGE_COUNT_MODE']
     )
 
     posts = pagination.items
@@ -47,12 +55,16 @@ def index():
 
 # User endpoint
 @main.get('/user/<string:username>')
+@page_cache.cached()
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     if user is None:
         abort(404)
 
-    posts = user.posts.order_by(Post.timestamp.desc()).all()
+    if current_user.is_authenticated:
+        current_user.preload_follows([user])
+
+    posts = user.posts.options(db.joinedload(Post.author)).order_by(Post.timestamp.desc()).all()
     return render_template('user.html', user=user, posts=posts)
 
 
@@ -103,8 +115,9 @@ def edit_profile_admin(id):
 
 
 @main.route('/post/<int:id>', methods=['GET', 'POST'])
+@page_cache.cached()
 def post(id):
-    post = Post.query.get_or_404(id)
+    post = Post.query.options(db.joinedload(Post.author)).get_or_404(id)
     form = CommentForm()
     if form.validate_on_submit():
         comment = Comment(
@@ -116,15 +129,12 @@ def post(id):
         db.session.add(comment)
         db.session.commit()
         flash('Your comment has been published')
-        return redirect(url_for('.post', id=post.id, page=-1))
-
-    page = request.args.get('page', 1, type=int)
-    if page == -1:
-        page = (post.comments.count() - 1) // current_app.config['APP_COMMENTS_PER_PAGE'] + 1
+        return redirect(url_for('.post', id=post.id, cursor=last_page_cursor(), _anchor='comments'))
 
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
-        error_out=False
+    pagination = CursorPagination(
+        post.comments.options(db.joinedload(Comment.author)), (Comment.timestamp, Comment.id),
+        request.args.get('cursor'), per_page=current_app.config['APP_COMMENTS_PER_PAGE'], descending=False,
+        count_mode=current_app.config['APP_PAGE_COUNT_MODE']
     )
 
     comments = pagination.items
@@ -151,6 +161,7 @@ def edit(id):
 
 
 @main.get('/follow/<string:username>')
+@read_primary
 @login_required
 @permission_required(Permission.FOLLOW)
 def follow(username):
@@ -170,6 +181,7 @@ def follow(username):
 
 
 @main.get('/unfollow/<string:username>')
+@read_primary
 @login_required
 @permission_required(Permission.FOLLOW)
 def unfollow(username):
@@ -195,13 +207,16 @@ def followers(username):
         flash('Invalid user')
         return redirect('.index')
 
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followers.paginate(
-        page, per_page=current_app.config['APP_FOLLOWERS_PER_PAGE'],
-        error_out=False
+    pagination = CursorPagination(
+        user.followers, (Follow.timestamp, Follow.follower_id), request.args.get('cursor'),
+        per_page=current_app.config['APP_FOLLOWERS_PER_PAGE'],
+        count_mode=current_app.config['APP_PAGE_COUNT_MODE']
     )
 
     follows = [{ 'user': item.follower, 'timestamp': item.timestamp } for item in pagination.items]
+    if current_user.is_authenticated:
+        current_user.preload_follows([follow['user'] for follow in follows])
+
     return render_template('followers.html', user=user, title='Followers of the user', endpoint='.followers',
         pagination=pagination, follows=follows)
 
@@ -213,13 +228,16 @@ def followed_by(username):
         flash('Invalid user')
         return redirect('.index')
 
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followed.paginate(
-        page, per_page=current_app.config['APP_FOLLOWERS_PER_PAGE'],
-        error_out=False
+    pagination = CursorPagination(
+        user.followed, (Follow.timestamp, Follow.followed_id), request.args.get('cursor'),
+        per_page=current_app.config['APP_FOLLOWERS_PER_PAGE'],
+        count_mode=current_app.config['APP_PAGE_COUNT_MODE']
     )
 
     follows = [{ 'user': item.followed, 'timestamp': item.timestamp } for item in pagination.items]
+    if current_user.is_authenticated:
+        current_user.preload_follows([follow['user'] for follow in follows])
+
     return render_template('followers.html', user=user, title='Followed by', endpoint='.followed_by',
         pagination=pagination, follows=follows)
 
@@ -244,17 +262,19 @@ def show_followed():
 @login_required
 @permission_required(Permission.MODERATE)
 def moderate():
-    page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
-        error_out=False
+    cursor = request.args.get('cursor')
+    pagination = CursorPagination(
+        Comment.query.options(db.joinedload(Comment.author)), (Comment.timestamp, Comment.id), cursor,
+        per_page=current_app.config['APP_COMMENTS_PER_PAGE'],
+        count_mode=current_app.config['APP_PAGE_COUNT_MODE']
     )
 
     comments = pagination.items
-    return render_template('moderate.html', comments=comments, pagination=pagination, page=page)
+    return render_template('moderate.html', comments=comments, pagination=pagination, cursor=cursor)
 
 
 @main.get('/moderate/enable/<int:id>')
+@read_primary
 @login_required
 @permission_required(Permission.MODERATE)
 def moderate_enable(id):
@@ -262,10 +282,11 @@ def moderate_enable(id):
     comment.disabled = False
     db.session.add(comment)
     db.session.commit()
-    return redirect(url_for('.moderate', page=request.args.get('page', 1, type=int)))
+    return redirect(url_for('.moderate', cursor=request.args.get('cursor')))
 
 
 @main.get('/moderate/disable/<int:id>')
+@read_primary
 @login_required
 @permission_required(Permission.MODERATE)
 def moderate_disable(id):
@@ -273,15 +294,70 @@ def moderate_disable(id):
     comment.disabled = True
     db.session.add(comment)
     db.session.commit()
-    return redirect(url_for('.moderate', page=request.args.get('page', 1, type=int)))
+    return redirect(url_for('.moderate', cursor=request.args.get('cursor')))
+
+
+@main.get('/search')
+def search():
+    q = request.args.get('q', '')
+    kind = request.args.get('type', 'posts')
+    if kind not in full_text.TABLES:
+        abort(404)
+
+    model, per_page = (Post, 'APP_POSTS_PER_PAGE') if kind == 'posts' else (Comment, 'APP_COMMENTS_PER_PAGE')
+    pagination = None
+    if q.strip():
+        try:
+            query, columns = full_text.search(model, q)
+            if model is Comment:
+                query = query.filter(Comment.disabled.isnot(True))
+
+            pagination = CursorPagination(
+                query.options(db.joinedload(model.author)), columns, request.args.get('cursor'),
+                per_page=current_app.config[per_page], count_mode=current_app.config['APP_PAGE_COUNT_MODE']
+            )
+        except ValidationError as e:
+            flash(str(e))
+
+    results = [row[0] for row in pagination.items] if pagination else []
+    return render_template('search.html', q=q, kind=kind, pagination=pagination,
+                           posts=results if kind == 'posts' else [], comments=results if kind == 'comments' else [])
+
+
+@main.get('/profiles')
+@login_required
+@admin_required
+def profiles():
+    return render_template('profiles.html', names=current_app.extensions['profiling'].names())
+
+
+@main.get('/profiles/<string:name>')
+@login_required
+@admin_required
+def profile_download(name):
+    path = current_app.extensions['profiling'].path(name)
+    if path is None:
+        abort(404)
+
+    if request.args.get('format') == 'collapsed':
+        response = make_response(collapse(pstats.Stats(path)))
+        response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+        response.headers['Content-Disposition'] = f'attachment; filename={name[:-len(".prof")]}.collapsed'
+        return response
+
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True, download_name=name)
 
 
 @main.after_app_request
 def after_request(response):
-    for query in get_debug_queries():
+    queries = get_debug_queries()
+    for query in queries:
         if query.duration >= current_app.config['APP_SLOW_DB_QUERY_TIME']:
             current_app.logger.warning(
                 f'Slow query: {query.statement}\nParameters: {query.parameters}\nTime: {query.duration}\nContext: {query.context}'
             )
 
+    if current_app.config['APP_QUERY_LOG']:
+        index_advisor.record(current_app.config['APP_QUERY_LOG'], queries)
+
     return response
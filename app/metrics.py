@@ -0,0 +1,289 @@
+import atexit, glob, json, os, threading, time
+from bisect import bisect_left
+from collections import defaultdict
+from flask import current_app, g, request, before_render_template, template_rendered
+from flask_sqlalchemy import get_debug_queries
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+HISTOGRAMS = {
+    'app_request_duration_seconds': ('Request latency', LATENCY_BUCKETS),
+    'app_response_size_bytes': ('Size of response bodies', SIZE_BUCKETS)
+}
+
+HELP = {
+    'app_requests_total': ('counter', 'Handled requests'),
+    'app_sql_queries_total': ('counter', 'SQL statements run by requests'),
+    'app_sql_seconds_total': ('counter', 'Time spent in SQL statements'),
+    'app_template_seconds_total': ('counter', 'Time spent rendering templates'),
+    'app_cache_entries': ('gauge', 'Entries held by in-process caches'),
+    'app_cache_hits_total': ('counter', 'Cache hits'),
+    'app_cache_misses_total': ('counter', 'Cache misses'),
+    'app_hashing_queue_depth': ('gauge', 'Password hashes running or waiting for a process'),
+    'app_hashing_calls_total': ('counter', 'Password hashes computed'),
+    'app_hashing_rejected_total': ('counter', 'Password hashes rejected because the queue was full'),
+    'app_hashing_seconds_total': ('counter', 'Time spent waiting for password hashes'),
+    'app_mail_queue_depth': ('gauge', 'Mails queued or waiting for a retry'),
+    'app_mail_sent_total': ('counter', 'Mails sent'),
+    'app_mail_failed_total': ('counter', 'Mails given up after all retries'),
+    'app_mail_retried_total': ('counter', 'Mail delivery retries'),
+    'app_last_seen_pending': ('gauge', 'Buffered last_seen updates'),
+    'app_replica_lag_seconds': ('gauge', 'Replication lag of read replicas')
+}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+
+def _component_samples(app):
+    """ (name, labels, value) read from the caches, queues and pools of the app """
+
+    from .render import render_cache
+
+    caches = { 'render': render_cache }
+    for name in ('identity_cache', 'token_cache', 'credentials_cache'):
+        if name in app.extensions:
+            caches[name.replace('_cache', '')] = app.extensions[name]
+    if 'count_cache' in app.extensions:
+        caches['count'] = app.extensions['count_cache'].entries
+
+    for name, cache in caches.items():
+        stats = cache.stats()
+        yield 'app_cache_entries', (('cache', name),), stats['size']
+        yield 'app_cache_hits_total', (('cache', name),), stats['hits']
+        yield 'app_cache_misses_total', (('cache', name),), stats['misses']
+
+    if 'page_cache' in app.extensions:
+        yield 'app_cache_entries', (('cache', 'page'),), len(app.extensions['page_cache'].entries)
+
+    if 'hashing' in app.extensions:
+        stats = app.extensions['hashing'].stats()
+        yield 'app_hashing_queue_depth', (), stats['depth']
+        yield 'app_hashing_calls_total', (), stats['calls']
+        yield 'app_hashing_rejected_total', (), stats['rejected']
+        yield 'app_hashing_seconds_total', (), stats['seconds']
+
+    if 'mail_queue' in app.extensions:
+        stats = app.extensions['mail_queue'].stats()
+        yield 'app_mail_queue_depth', (), stats['depth']
+        yield 'app_mail_sent_total', (), stats['sent']
+        yield 'app_mail_failed_total', (), stats['failed']
+        yield 'app_mail_retried_total', (), stats['retried']
+
+    if 'last_seen' in app.extensions:
+        yield 'app_last_seen_pending', (), len(app.extensions['last_seen'].pending)
+
+    if 'replicas' in app.extensions:
+        for key, lag in app.extensions['replicas'].lag.items():
+            if lag is not None:
+                yield 'app_replica_lag_seconds', (('replica', key),), lag
+
+
+class _MetricsState:
+    def __init__(self, app):
+        self.app = app
+        self.directory = app.config['APP_METRICS_DIR']
+        self.interval = app.config['APP_METRICS_FLUSH_INTERVAL']
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.last_write = time.monotonic()
+        self.lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][1]
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [[0] * (len(buckets) + 1), 0.0, 0]
+
+            histogram[0][bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, labels)] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, list(buckets), total, count]
+                               for (name, labels), (buckets, total, count) in self.histograms.items()],
+                'components': [[name, labels, value] for name, labels, value in _component_samples(self.app)]
+            }
+
+    def write(self):
+        """ Stores the metrics of this worker next to the other workers' files """
+
+        self.last_write = time.monotonic()
+        if not self.directory:
+            return
+
+        path = os.path.join(self.directory, f'metrics-{os.getpid()}.json')
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            self.app.logger.exception(f'Could not write metrics to {path}')
+
+    def maybe_write(self):
+        if time.monotonic() - self.last_write >= self.interval:
+            self.write()
+
+    def collect(self):
+        """ Metrics summed over every worker, components only of the workers still running """
+
+        if not self.directory:
+            snapshots = [self.snapshot()]
+        else:
+            self.write()
+            snapshots = []
+            for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        counters, histograms, components = defaultdict(float), {}, defaultdict(float)
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                counters[(name, tuple(map(tuple, labels)))] += value
+            for name, labels, buckets, total, count in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+                merged[2] += count
+            if _alive(snapshot['pid']):
+                for name, labels, value in snapshot['components']:
+                    components[(name, tuple(map(tuple, labels)))] += value
+
+        return counters, histograms, components
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def render(counters, histograms, components):
+    """ Prometheus text exposition format """
+
+    lines = []
+    samples = defaultdict(list)
+    for (name, labels), value in list(counters.items()) + list(components.items()):
+        samples[name].append((labels, value))
+
+    for name in sorted(samples):
+        kind, help = HELP[name]
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{_format_labels(labels)} {value}' for labels, value in sorted(samples[name])]
+
+    for name in sorted({ name for name, _ in histograms }):
+        help, buckets = HISTOGRAMS[name]
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+        for (sample, labels), (counts, total, count) in sorted(histograms.items()):
+            if sample != name:
+                continue
+
+            cumulative = 0
+            for bound, bucket in zip(buckets + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics:
+    """ Per-endpoint request, SQL and template metrics exposed at /metrics
+
+    Every worker keeps its metrics in memory and writes them to its own file in
+    APP_METRICS_DIR at most every APP_METRICS_FLUSH_INTERVAL seconds, a scrape sums
+    the files of all workers. Without APP_METRICS_DIR only the scraped worker is seen.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        state = _MetricsState(app)
+        app.extensions['metrics'] = state
+        if state.directory:
+            os.makedirs(state.directory, exist_ok=True)
+            atexit.register(state.write)
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        before_render_template.connect(self._before_render_template, app)
+        template_rendered.connect(self._template_rendered, app)
+        app.add_url_rule('/metrics', 'metrics', self._view)
+
+    @staticmethod
+    def _before_request():
+        g.metrics_start = time.perf_counter()
+        g.metrics_template_seconds = 0.0
+
+    @staticmethod
+    def _after_request(response):
+        if 'metrics_start' not in g or request.endpoint in (None, 'metrics'):
+            return response
+
+        state = current_app.extensions['metrics']
+        labels = (('endpoint', request.endpoint),)
+        state.observe('app_request_duration_seconds', labels, time.perf_counter() - g.metrics_start)
+        state.inc('app_requests_total', labels + (('method', request.method), ('status', response.status_code)))
+
+        queries = get_debug_queries()
+        state.inc('app_sql_queries_total', labels, len(queries))
+        state.inc('app_sql_seconds_total', labels, sum(query.duration for query in queries))
+        state.inc('app_template_seconds_total', labels, g.metrics_template_seconds)
+
+        size = response.calculate_content_length()
+        if size is not None:
+            state.observe('app_response_size_bytes', labels, size)
+
+        state.maybe_write()
+        return response
+
+    @staticmethod
+    def _before_render_template(app, template, context, **kwargs):
+        g.metrics_template_start = time.perf_counter()
+
+    @staticmethod
+    def _template_rendered(app, template, context, **kwargs):
+        if 'metrics_template_start' in g and 'metrics_template_seconds' in g:
+            g.metrics_template_seconds += time.perf_counter() - g.pop('metrics_template_start')
+
+    @staticmethod
+    def _view():
+        token = current_app.config['APP_METRICS_TOKEN']
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            return current_app.response_class('forbidden\n', status=403, content_type='text/plain')
+
+        body = render(*current_app.extensions['metrics'].collect())
+        return current_app.response_class(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+metrics = Metrics()
@@ -1,13 +1,26 @@
-import hashlib, bleach, jwt, datetime
+import hashlib, jwt, datetime
 from . import db
-from werkzeug.security import generate_password_hash, check_password_hash
 from . import login_manager
+from . import search
 from flask_login import UserMixin, AnonymousUserMixin
-from flask import current_app, request, url_for
+from flask import current_app, request, url_for, g, has_request_context
 from itsdangerous.url_safe import URLSafeSerializer
 from sqlalchemy.sql import func
-from markdown import markdown
 from .exceptions import ValidationError
+from .render import render_html, POST_ALLOWED_TAGS, COMMENT_ALLOWED_TAGS
+from .identity import identity_cache
+from .hashing import hasher
+from .replicas import primary
+from .counts import changed
+
+
+def project(fields, getters):
+    """ JSON of the `getters` named in `fields`, every one when `fields` is None
+
+    Only the requested getters run, unrequested urls and counters are never computed.
+    """
+
+    return { name: get() for name, get in getters.items() if fields is None or name in fields }
 
 
 class Comment(db.Model):
@@ -20,21 +33,37 @@ class Comment(db.Model):
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
 
+    __table_args__ = (
+        db.Index('ix_comments_post_id_timestamp', 'post_id', 'timestamp'),
+        db.Index('ix_comments_author_id', 'author_id'),
+        db.Index('ix_comments_timestamp', 'timestamp'),
+    )
+
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiatior):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'), tags=allowed_tags, strip=True))
-
-    def to_json(self):
-        json_comment = {
-            'url': url_for('api.get_comment', id=self.id),
-            'post_url': url_for('api.get_post', id=self.post_id),
-            'body': self.body,
-            'body_html': self.body_html,
-            'timestamp': self.timestamp,
-            'author_url': url_for('api.get_user', id=self.author_id)
-        }
+        target.body_html = render_html(value, COMMENT_ALLOWED_TAGS)
+        search.mark(target)
+
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        connection.execute(Post.__table__.update().where(Post.id == target.post_id)
+                           .values(comment_count=Post.comment_count + 1))
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        connection.execute(Post.__table__.update().where(Post.id == target.post_id)
+                           .values(comment_count=Post.comment_count - 1))
+
+    def to_json(self, fields=None):
+        json_comment = project(fields, {
+            'id': lambda: self.id,
+            'url': lambda: url_for('api.get_comment', id=self.id),
+            'post_url': lambda: url_for('api.get_post', id=self.post_id),
+            'body': lambda: self.body,
+            'body_html': lambda: self.body_html,
+            'timestamp': lambda: self.timestamp,
+            'author_url': lambda: url_for('api.get_user', id=self.author_id)
+        })
 
         return json_comment
 
@@ -48,6 +77,8 @@ class Comment(db.Model):
 
 
 db.event.listen(Comment.body, 'set', Comment.on_changed_body)
+db.event.listen(Comment, 'after_insert', Comment.on_insert)
+db.event.listen(Comment, 'after_delete', Comment.on_delete)
 
 
 class Permission:
@@ -64,6 +95,93 @@ class Follow(db.Model):
     followed_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
     timestamp = db.Column(db.DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        db.Index('ix_follows_followed_id_timestamp', 'followed_id', 'timestamp'),
+        db.Index('ix_follows_follower_id_timestamp', 'follower_id', 'timestamp'),
+    )
+
+    @staticmethod
+    def update_counters(connection, target, delta):
+        connection.execute(User.__table__.update().where(User.id == target.followed_id)
+                           .values(follower_count=User.follower_count + delta))
+        connection.execute(User.__table__.update().where(User.id == target.follower_id)
+                           .values(followed_count=User.followed_count + delta))
+
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        Follow.update_counters(connection, target, 1)
+        changed(db.object_session(target), TimelineEntry.__tablename__)
+
+        # Backfill the follower's timeline with recent posts of the followed user,
+        # pull-on-read authors are served from the posts table instead
+        pull = connection.scalar(
+            db.select(User.timeline_pull).where(User.id == target.followed_id))
+        if pull:
+            return
+
+        connection.execute(TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select(db.literal(target.follower_id), Post.id, Post.timestamp)
+                .where(Post.author_id == target.followed_id)
+                .order_by(Post.timestamp.desc())
+                .limit(current_app.config['APP_TIMELINE_BACKFILL'])
+        ))
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        Follow.update_counters(connection, target, -1)
+        changed(db.object_session(target), TimelineEntry.__tablename__)
+        connection.execute(TimelineEntry.__table__.delete().where(
+            TimelineEntry.user_id == target.follower_id,
+            TimelineEntry.post_id.in_(db.select(Post.id).where(Post.author_id == target.followed_id))
+        ))
+
+        # A pull-on-read author back at half the fan-out limit is pushed to its followers
+        # again, the gap keeps authors around the limit from switching on every follow
+        author = connection.execute(db.select(User.follower_count, User.timeline_pull)
+                                    .where(User.id == target.followed_id)).first()
+        if author is None or not author.timeline_pull \
+                or author.follower_count > current_app.config['APP_TIMELINE_FANOUT_LIMIT'] // 2:
+            return
+
+        connection.execute(User.__table__.update().where(User.id == target.followed_id).values(timeline_pull=False))
+        posts = db.select(Post.id).where(Post.author_id == target.followed_id)
+        connection.execute(TimelineEntry.__table__.delete().where(TimelineEntry.post_id.in_(posts)))
+        latest = db.select(Post.id, Post.timestamp) \
+            .where(Post.author_id == target.followed_id) \
+            .order_by(Post.timestamp.desc()) \
+            .limit(current_app.config['APP_TIMELINE_BACKFILL']) \
+            .subquery()
+        connection.execute(TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select(Follow.follower_id, latest.c.id, latest.c.timestamp)
+                .join(latest, db.true())
+                .where(Follow.followed_id == target.followed_id)
+        ))
+
+
+db.event.listen(Follow, 'after_insert', Follow.on_insert)
+db.event.listen(Follow, 'after_delete', Follow.on_delete)
+
+
+class TimelineEntry(db.Model):
+    __tablename__ = 'timelines'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime(timezone=True))
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+
+class ReplicaHeartbeat(db.Model):
+    """ Single row rewritten on the primary, its age on a replica is the replication lag """
+
+    __tablename__ = 'replica_heartbeat'
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime)
+
 
 class Post(db.Model):
     __tablename__ = 'posts'
@@ -72,28 +190,66 @@ class Post(db.Model):
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime(timezone=True), index=True, server_default=func.now())
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    comment_count = db.Column(db.Integer, default=0)
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
 
+    __table_args__ = (
+        db.Index('ix_posts_author_id_timestamp', 'author_id', 'timestamp'),
+    )
+
     @staticmethod
     def on_change_body(target, value, oldValue, initiator):
-        allowed_tags = [
-            'a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'p',
-            'i', 'li', 'ol', 'pre', 'strong', 'ul', 'h1', 'h2', 'h3', 'h4'
-        ]
-
-        target.body_html = bleach.linkify(
-            bleach.clean(markdown(value, output_format='html'), tags=allowed_tags, strip=True))
-
-    def to_json(self):
-        json_post = {
-            'url': url_for('api.get_post', id=self.id),
-            'body': self.body,
-            'body_html': self.body_html,
-            'timestamp': self.timestamp,
-            'author_url': url_for('api.get_user', id=self.author_id),
-            'comments_url': url_for('api.get_post_comments', id=self.id),
-            'comment_count': self.comments.count()
-        }
+        target.body_html = render_html(value, POST_ALLOWED_TAGS)
+        search.mark(target)
+
+    @staticmethod
+    def recount_counters():
+        db.session.execute(Post.__table__.update().values(
+            comment_count=db.select(func.count(Comment.id)).where(Comment.post_id == Post.id).scalar_subquery()
+        ))
+
+    @staticmethod
+    def update_counters(connection, target, delta):
+        connection.execute(User.__table__.update().where(User.id == target.author_id)
+                           .values(post_count=User.post_count + delta))
+
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        Post.update_counters(connection, target, 1)
+        changed(db.object_session(target), TimelineEntry.__tablename__)
+
+        # Fan-out on write: push the new post to the timeline of every follower,
+        # authors with too many followers are read with pull-on-read instead
+        follower_count = connection.scalar(db.select(User.follower_count).where(User.id == target.author_id))
+        if follower_count and follower_count > current_app.config['APP_TIMELINE_FANOUT_LIMIT']:
+            connection.execute(
+                User.__table__.update().where(User.id == target.author_id).values(timeline_pull=True))
+            return
+
+        connection.execute(TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select(Follow.follower_id, Post.id, Post.timestamp)
+                .join(Post, Post.author_id == Follow.followed_id)
+                .where(Post.id == target.id)
+        ))
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        Post.update_counters(connection, target, -1)
+        changed(db.object_session(target), TimelineEntry.__tablename__)
+        connection.execute(TimelineEntry.__table__.delete().where(TimelineEntry.post_id == target.id))
+
+    def to_json(self, fields=None):
+        json_post = project(fields, {
+            'id': lambda: self.id,
+            'url': lambda: url_for('api.get_post', id=self.id),
+            'body': lambda: self.body,
+            'body_html': lambda: self.body_html,
+            'timestamp': lambda: self.timestamp,
+            'author_url': lambda: url_for('api.get_user', id=self.author_id),
+            'comments_url': lambda: url_for('api.get_post_comments', id=self.id),
+            'comment_count': lambda: self.comment_count
+        })
 
         return json_post
 
@@ -107,6 +263,9 @@ class Post(db.Model):
 
 
 db.event.listen(Post.body, 'set', Post.on_change_body)
+db.event.listen(Post, 'after_insert', Post.on_insert)
+# Before the row goes, the timelines foreign key is checked on every statement
+db.event.listen(Post, 'before_delete', Post.on_delete)
 
 
 class Role(db.Model):
@@ -174,6 +333,10 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(128))
     confirmed = db.Column(db.Boolean, default=False)
     avatar_hash = db.Column(db.String(32))
+    timeline_pull = db.Column(db.Boolean, default=False)
+    post_count = db.Column(db.Integer, default=0)
+    follower_count = db.Column(db.Integer, default=0)
+    followed_count = db.Column(db.Integer, default=0)
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     comments = db.relationship('Comment', backref='author', lazy='dynamic')
 
@@ -211,16 +374,66 @@ class User(UserMixin, db.Model):
                 db.session.add(user)
                 db.session.commit()
 
-    def to_json(self):
-        json_user = {
-            'url': url_for('api.get_user', id=self.id),
-            'username': self.username,
-            'member_since': self.member_since,
-            'last_seen': self.last_seen,
-            'posts_url': url_for('api.get_user_posts', id=self.id),
-            'followed_posts_url': url_for('api.get_user_followed_posts', id=self.id),
-            'post_count': self.posts.count()
-        }
+    @staticmethod
+    def recount_counters():
+        def count(column, where):
+            return db.select(func.count(column)).where(where).scalar_subquery()
+
+        db.session.execute(User.__table__.update().values(
+            post_count=count(Post.id, Post.author_id == User.id),
+            follower_count=count(Follow.follower_id, Follow.followed_id == User.id),
+            followed_count=count(Follow.followed_id, Follow.follower_id == User.id)
+        ))
+
+    @staticmethod
+    def rebuild_timelines(batch_size=100):
+        """ Recreate every timeline from follows, needs up to date follower counts
+
+        Like a new follow, every follow brings the latest APP_TIMELINE_BACKFILL posts of the
+        followed user. Timelines are rebuilt and committed `batch_size` users at a time.
+        """
+
+        db.session.execute(User.__table__.update().values(
+            timeline_pull=User.follower_count > current_app.config['APP_TIMELINE_FANOUT_LIMIT']))
+        db.session.commit()
+
+        last_id = 0
+        while True:
+            user_ids = db.session.scalars(db.select(User.id).where(User.id > last_id)
+                                          .order_by(User.id).limit(batch_size)).all()
+            if not user_ids:
+                return
+
+            last_id = user_ids[-1]
+            latest = db.select(
+                Follow.follower_id, Post.id, Post.timestamp,
+                func.row_number().over(partition_by=(Follow.follower_id, Follow.followed_id),
+                                       order_by=(Post.timestamp.desc(), Post.id.desc())).label('position')
+            ) \
+                .join(Post, Post.author_id == Follow.followed_id) \
+                .join(User, User.id == Post.author_id) \
+                .where(Follow.follower_id.in_(user_ids), User.timeline_pull.isnot(True)) \
+                .subquery()
+            db.session.execute(TimelineEntry.__table__.delete().where(TimelineEntry.user_id.in_(user_ids)))
+            db.session.execute(TimelineEntry.__table__.insert().from_select(
+                ['user_id', 'post_id', 'timestamp'],
+                db.select(latest.c.follower_id, latest.c.id, latest.c.timestamp)
+                    .where(latest.c.position <= current_app.config['APP_TIMELINE_BACKFILL'])
+            ))
+            changed(db.session, TimelineEntry.__tablename__)
+            db.session.commit()
+
+    def to_json(self, fields=None):
+        json_user = project(fields, {
+            'id': lambda: self.id,
+            'url': lambda: url_for('api.get_user', id=self.id),
+            'username': lambda: self.username,
+            'member_since': lambda: self.member_since,
+            'last_seen': lambda: self.last_seen,
+            'posts_url': lambda: url_for('api.get_user_posts', id=self.id),
+            'followed_posts_url': lambda: url_for('api.get_user_followed_posts', id=self.id),
+            'post_count': lambda: self.post_count
+        })
 
         return json_user
 
@@ -249,7 +462,36 @@ class User(UserMixin, db.Model):
 
     @property
     def followed_posts(self):
-        return Post.query.join(Follow, Follow.followed_id == Post.author_id).filter(Follow.follower_id == self.id)
+        return self.timeline()[0]
+
+    def pull_authors(self):
+        """ Followed pull-on-read authors, their posts are not in the timeline of this user """
+
+        return db.select(Follow.followed_id) \
+            .join(User, User.id == Follow.followed_id) \
+            .where(Follow.follower_id == self.id, User.timeline_pull.is_(True))
+
+    def timeline(self, pull=None):
+        """ Returns (query, columns), the followed posts and the keyset columns to page them by
+
+        Without pull-on-read authors the posts come from `timelines` alone, ordered by its
+        (user_id, timestamp) index. Otherwise the posts of those authors are merged in and the
+        query is driven from `posts`. `pull` says whether the user follows any of them, it is
+        looked up when None.
+        """
+
+        if pull is None:
+            pull = db.session.query(self.pull_authors().exists()).scalar()
+
+        if not pull:
+            query = Post.query.join(TimelineEntry, TimelineEntry.post_id == Post.id) \
+                .filter(TimelineEntry.user_id == self.id)
+            # Timeline rows copy the timestamp of their post, the labels name the Post attributes
+            return query, (TimelineEntry.timestamp.label('timestamp'), TimelineEntry.post_id.label('id'))
+
+        timeline = db.select(TimelineEntry.post_id).where(TimelineEntry.user_id == self.id)
+        query = Post.query.filter(db.or_(Post.id.in_(timeline), Post.author_id.in_(self.pull_authors())))
+        return query, (Post.timestamp, Post.id)
 
     @property
     def password(self) -> None:
@@ -257,10 +499,10 @@ class User(UserMixin, db.Model):
 
     @password.setter
     def password(self, password: str) -> None:
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hasher.generate(password)
 
     def verify_password(self, password: str) -> bool:
-        return check_password_hash(self.password_hash, password)
+        return hasher.check(self.password_hash, password)
 
     def __repr__(self) -> str:
         return '<User %r' % self.username
@@ -296,22 +538,43 @@ class User(UserMixin, db.Model):
         if not self.is_following(user):
             f = Follow(follower=self, followed=user)
             db.session.add(f)
+            _cache_follow(self.id, user.id, True)
 
     def unfollow(self, user):
         f = self.followed.filter_by(followed_id=user.id).first()
         if f: db.session.delete(f)
+        _cache_follow(self.id, user.id, False)
 
     def is_following(self, user):
         if user.id is None:
             return False
 
-        return self.followed.filter_by(followed_id=user.id).first() is not None
+        return _is_following(self.id, user.id)
 
     def is_followed_by(self, user):
         if user.id is None:
             return False
 
-        return self.followers.filter_by(follower_id=user.id).first() is not None
+        return _is_following(user.id, self.id)
+
+    def preload_follows(self, users):
+        """ Load the relationships in both directions between the user and `users` in one query """
+
+        cache = _follow_cache()
+        ids = {user.id for user in users if user.id is not None}
+        if cache is None or self.id is None or not ids:
+            return
+
+        for id in ids:
+            cache[(self.id, id)] = cache[(id, self.id)] = False
+
+        query = db.session.query(Follow.follower_id, Follow.followed_id).filter(db.or_(
+            db.and_(Follow.follower_id == self.id, Follow.followed_id.in_(ids)),
+            db.and_(Follow.followed_id == self.id, Follow.follower_id.in_(ids))
+        ))
+
+        for follower_id, followed_id in query:
+            cache[(follower_id, followed_id)] = True
 
     def generate_auth_token(self, expiration=3600):
         return jwt.encode(
@@ -324,18 +587,62 @@ class User(UserMixin, db.Model):
         )
 
     @staticmethod
-    def verify_auth_token(token):
+    def decode_auth_token(token):
         try:
-            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+            return jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
         except:
             return None
 
+    @staticmethod
+    def verify_auth_token(token):
+        data = User.decode_auth_token(token)
+        if data is None:
+            return None
+
         return User.query.get(data['id'])
 
 
+def _follow_cache():
+    """ Follow relationships known in the current request, keyed by (follower_id, followed_id) """
+
+    if not has_request_context():
+        return None
+
+    if 'follow_cache' not in g:
+        g.follow_cache = {}
+
+    return g.follow_cache
+
+
+def _cache_follow(follower_id, followed_id, following):
+    cache = _follow_cache()
+    if cache is not None and follower_id is not None and followed_id is not None:
+        cache[(follower_id, followed_id)] = following
+
+
+def _is_following(follower_id, followed_id):
+    cache = _follow_cache()
+    if cache is not None and (follower_id, followed_id) in cache:
+        return cache[(follower_id, followed_id)]
+
+    following = Follow.query.filter_by(follower_id=follower_id, followed_id=followed_id).first() is not None
+    _cache_follow(follower_id, followed_id, following)
+    return following
+
+
 @login_manager.user_loader
 def load_user(user_id: int) -> User:
-    return User.query.get(int(user_id))
+    user = identity_cache.get(int(user_id))
+    if user is not None:
+        return user
+
+    with primary():
+        user = User.query.options(db.joinedload(User.role)).get(int(user_id))
+
+    if user is not None:
+        identity_cache.set(user)
+
+    return user
 
 
 class AnonymousUser(AnonymousUserMixin):
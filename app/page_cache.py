@@ -0,0 +1,164 @@
+import threading, time
+from collections import OrderedDict, defaultdict
+from functools import wraps
+from flask import current_app, g, has_request_context, make_response, request, session
+from flask_login import current_user
+from . import db
+
+
+class _PageCacheState:
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.entries = OrderedDict()
+        self.keys_by_tag = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            if entry['expires'] <= time.monotonic():
+                self._remove(key)
+                return None
+
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, status, content_type, tags):
+        entry = {
+            'body': body,
+            'status': status,
+            'content_type': content_type,
+            'tags': tags,
+            'expires': time.monotonic() + self.ttl
+        }
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = entry
+            self.size += len(body)
+            for tag in tags:
+                self.keys_by_tag[tag].add(key)
+
+            while self.size > self.max_bytes and self.entries:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate(self, tags):
+        with self.lock:
+            for tag in tags:
+                for key in list(self.keys_by_tag.get(tag, ())):
+                    self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= len(entry['body'])
+        for tag in entry['tags']:
+            keys = self.keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_tag[tag]
+
+
+class PageCache:
+    """ Full response cache for anonymous GET requests
+
+    Every row loaded while a page renders tags the cached page with `<table>:<id>`,
+    a commit touching that row (or adding rows to a list the page shows) drops the
+    page. The cache lives in each worker process, APP_PAGE_CACHE_TTL bounds how long
+    another worker's writes can go unnoticed. Pages of requests routed to a read replica
+    are not cached.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['page_cache'] = _PageCacheState(app.config['APP_PAGE_CACHE_MAX_BYTES'],
+                                                       app.config['APP_PAGE_CACHE_TTL'])
+
+    def cached(self, tags=()):
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if not current_app.config['APP_PAGE_CACHE'] or request.method != 'GET' \
+                        or current_user.is_authenticated or '_flashes' in session:
+                    return f(*args, **kwargs)
+
+                state = current_app.extensions['page_cache']
+                key = request.full_path
+                entry = state.get(key)
+                if entry is not None:
+                    response = current_app.response_class(entry['body'], status=entry['status'],
+                                                          content_type=entry['content_type'])
+                    response.headers['X-Page-Cache'] = 'HIT'
+                    return response
+
+                g.page_cache_tags = set(tags)
+                response = make_response(f(*args, **kwargs))
+                # Pages read from a lagging replica would be cached after the commit that invalidated them
+                if response.status_code == 200 and not response.direct_passthrough and g.get('replica') is None:
+                    state.set(key, response.get_data(), response.status_code, response.content_type,
+                              frozenset(g.page_cache_tags))
+
+                response.headers['X-Page-Cache'] = 'MISS'
+                return response
+            return decorated_function
+        return decorator
+
+
+page_cache = PageCache()
+
+
+def _row_tags(obj):
+    from .models import Post, Comment, Follow, User
+
+    if isinstance(obj, Post):
+        return { f'posts:{obj.id}', f'users:{obj.author_id}', 'posts' }
+    if isinstance(obj, Comment):
+        return { f'comments:{obj.id}', f'posts:{obj.post_id}' }
+    if isinstance(obj, Follow):
+        return { f'users:{obj.follower_id}', f'users:{obj.followed_id}' }
+    if isinstance(obj, User):
+        return { f'users:{obj.id}' }
+
+    return set()
+
+
+@db.event.listens_for(db.Model, 'load', propagate=True)
+def on_load(target, context):
+    if has_request_context() and 'page_cache_tags' in g:
+        identity = db.inspect(target).identity
+        if len(identity) == 1:
+            g.page_cache_tags.add(f'{target.__table__.name}:{identity[0]}')
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def after_flush(session, flush_context):
+    tags = session.info.setdefault('page_cache_tags', set())
+    dirty = [obj for obj in session.dirty if session.is_modified(obj, include_collections=False)]
+    for obj in list(session.new) + dirty + list(session.deleted):
+        tags.update(_row_tags(obj))
+
+    if 'page_cache' in current_app.extensions:
+        current_app.extensions['page_cache'].invalidate(tags)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def after_commit(session):
+    # Pages rendered by other requests before this commit may hold the old rows
+    tags = session.info.pop('page_cache_tags', ())
+    if 'page_cache' in current_app.extensions:
+        current_app.extensions['page_cache'].invalidate(tags)
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def after_rollback(session):
+    session.info.pop('page_cache_tags', None)
@@ -0,0 +1,125 @@
+import base64, json, datetime
+from . import db
+from .exceptions import ValidationError
+from .counts import count_cache, validate_mode
+
+
+def encode_cursor(values, backwards=False) -> str:
+    """ Serialize keyset values into an opaque, url safe cursor """
+
+    data = {
+        'k': [{ 'dt': value.isoformat() } if isinstance(value, datetime.datetime) else value for value in values]
+            if values is not None else None,
+        'b': backwards
+    }
+
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        values = data['k']
+        if values is not None:
+            values = [datetime.datetime.fromisoformat(value['dt']) if isinstance(value, dict) else value
+                      for value in values]
+
+        return values, bool(data['b'])
+    except (ValueError, TypeError, KeyError):
+        raise ValidationError('Invalid cursor')
+
+
+def last_page_cursor() -> str:
+    return encode_cursor(None, backwards=True)
+
+
+def keyset_filter(columns, values, reverse=False):
+    """ Rows strictly after `values` in (reversed) `columns` order, expanded for index usage """
+
+    column, value = columns[0], values[0]
+    after = column < value if reverse else column > value
+    if len(columns) == 1:
+        return after
+
+    return db.or_(after, db.and_(column == value, keyset_filter(columns[1:], values[1:], reverse)))
+
+
+class CursorPagination:
+    """ Keyset pagination ordered by `columns`, the last column has to be unique """
+
+    def __init__(self, query, columns, cursor=None, per_page=10, descending=True, count_mode='exact'):
+        self._prepare(query, columns, cursor, per_page, descending, count_mode)
+        self._page(self._window.all())
+
+    @classmethod
+    async def execute(cls, session, statement, columns, cursor=None, per_page=10, descending=True,
+                      count_mode='exact'):
+        """ Pagination of a `select` of one entity run on an AsyncSession, counted up front """
+
+        validate_mode(count_mode)
+        self = cls.__new__(cls)
+        self._prepare(statement, columns, cursor, per_page, descending, count_mode)
+        self._page((await session.execute(self._window)).scalars().all())
+        if count_mode == 'none':
+            self._count = (None, False)
+            return self
+
+        statement = statement.order_by(None)
+        url = str(session.bind.url)
+        self._count = count_cache.lookup(statement, url, count_mode)
+        if self._count is None:
+            value = await session.scalar(db.select(db.func.count()).select_from(statement.subquery()))
+            count_cache.store(statement, url, value)
+            self._count = (value, False)
+
+        return self
+
+    def _prepare(self, query, columns, cursor, per_page, descending, count_mode):
+        self.query = query
+        self.columns = columns
+        self.per_page = per_page
+        self.count_mode = count_mode
+        self._count = None
+        self.values, self.backwards = decode_cursor(cursor) if cursor else (None, False)
+        if self.values is not None and len(self.values) != len(columns):
+            raise ValidationError('Invalid cursor')
+
+        # Walking backwards is walking forwards in the reversed order
+        reverse = descending != self.backwards
+        order = [column.desc() if reverse else column.asc() for column in columns]
+        if self.values is not None:
+            query = query.filter(keyset_filter(columns, self.values, reverse))
+
+        self._window = query.order_by(*order).limit(per_page + 1)
+
+    def _page(self, items):
+        more = len(items) > self.per_page
+        items = items[:self.per_page]
+        if self.backwards:
+            items.reverse()
+            self.has_prev, self.has_next = more, self.values is not None
+        else:
+            self.has_prev, self.has_next = self.values is not None, more
+
+        self.items = items
+        self.prev_cursor = encode_cursor(self._key(items[0]), backwards=True) if self.has_prev and items else None
+        self.next_cursor = encode_cursor(self._key(items[-1])) if self.has_next and items else None
+        self.has_prev = self.prev_cursor is not None
+        self.has_next = self.next_cursor is not None
+
+    def _key(self, item):
+        return [getattr(item, column.key) for column in self.columns]
+
+    @property
+    def total(self):
+        """ Number of items in all pages, None when counting is disabled """
+
+        if self._count is None:
+            self._count = count_cache.count(self.query, self.count_mode)
+
+        return self._count[0]
+
+    @property
+    def total_is_estimate(self):
+        self.total
+        return self._count[1]
@@ -0,0 +1,182 @@
+import cProfile, os, pstats, random, re, threading, uuid
+from collections import defaultdict
+from datetime import datetime
+from flask import current_app, g, request
+from flask_login import current_user
+
+
+# Deeper stacks and paths with less of the total time are cut off in the collapsed output
+MAX_DEPTH = 64
+MIN_SHARE = 0.001
+
+
+def _label(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+
+    return f'{os.path.basename(filename)}:{line}({name})'
+
+
+def collapse(stats):
+    """ Collapsed stacks (`a;b;c <microseconds>`) for flamegraph tools
+
+    cProfile only records caller/callee pairs, the time of a function is split
+    among its callers in proportion to the time every caller spent in it.
+    """
+
+    callees = defaultdict(dict)
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge
+
+    roots = [(func, tt, ct) for func, (cc, nc, tt, ct, callers) in stats.stats.items() if not callers]
+    threshold = sum(ct for _, _, ct in roots) * MIN_SHARE
+
+    samples = defaultdict(float)
+    def walk(func, path, tt, ct):
+        path = path + (_label(func),)
+        samples[';'.join(path)] += tt
+        total = stats.stats[func][3]
+        if len(path) >= MAX_DEPTH or not total:
+            return
+
+        share = ct / total
+        for callee, (_, _, edge_tt, edge_ct) in callees[func].items():
+            if edge_ct * share >= threshold and _label(callee) not in path:
+                walk(callee, path, edge_tt * share, edge_ct * share)
+
+    for func, tt, ct in roots:
+        walk(func, (), tt, ct)
+
+    return ''.join(f'{stack} {round(seconds * 1e6)}\n' for stack, seconds in sorted(samples.items())
+                   if round(seconds * 1e6) > 0)
+
+
+class _ProfilingState:
+    def __init__(self, app):
+        self.app = app
+        self.directory = app.config['APP_PROFILE_DIR']
+        self.sample_rate = app.config['APP_PROFILE_SAMPLE_RATE']
+        self.header = app.config['APP_PROFILE_HEADER']
+        self.keep = app.config['APP_PROFILE_KEEP']
+        # Set by `flask profile`, requests add up in one file per endpoint
+        self.aggregate = False
+        self.endpoint_stats = {}
+        self.lock = threading.Lock()
+
+    def save(self, profile, endpoint):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.aggregate:
+            with self.lock:
+                stats = self.endpoint_stats.get(endpoint)
+                if stats is None:
+                    stats = self.endpoint_stats[endpoint] = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+
+                path = os.path.join(self.directory, endpoint)
+                stats.dump_stats(path + '.prof')
+                with open(path + '.collapsed', 'w') as f:
+                    f.write(collapse(stats))
+
+            return endpoint + '.prof'
+
+        name = f'{datetime.utcnow():%Y%m%dT%H%M%S}-{endpoint}-{uuid.uuid4().hex[:8]}.prof'
+        profile.dump_stats(os.path.join(self.directory, name))
+        self._prune()
+        return name
+
+    def _prune(self):
+        for name in self.names()[self.keep:]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def names(self):
+        if not os.path.isdir(self.directory):
+            return []
+
+        return sorted((name for name in os.listdir(self.directory) if name.endswith('.prof')), reverse=True)
+
+    def path(self, name):
+        """ Path of a stored profile, None for names outside the profile directory """
+
+        if not re.fullmatch(r'[\w.-]+\.prof', name) or name not in self.names():
+            return None
+
+        return os.path.join(self.directory, name)
+
+
+class RequestProfiler:
+    """ cProfile for sampled requests and for requests carrying APP_PROFILE_HEADER
+
+    A fraction APP_PROFILE_SAMPLE_RATE of all requests is profiled. The header only
+    starts the profiler when the request was made by an administrator, the name of the
+    stored profile is returned in the same header. Profiles are kept in APP_PROFILE_DIR,
+    the oldest ones are removed past APP_PROFILE_KEEP.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['profiling'] = _ProfilingState(app)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    @property
+    def state(self) -> _ProfilingState:
+        return current_app.extensions['profiling']
+
+    @staticmethod
+    def _requested(user):
+        state = current_app.extensions['profiling']
+        return state.header in request.headers and user.is_authenticated and user.is_administrator()
+
+    @staticmethod
+    def _start(sampled, requested):
+        g.profile = cProfile.Profile()
+        g.profile_sampled = sampled
+        g.profile_requested = requested
+        g.profile.enable()
+
+    def _before_request(self):
+        state = current_app.extensions['profiling']
+        sampled = state.sample_rate > 0 and random.random() < state.sample_rate
+        # API users are only known after the api blueprint authenticated the request, it calls `authorized`
+        requested = request.blueprint != 'api' and self._requested(current_user)
+        if sampled or requested:
+            self._start(sampled, requested)
+
+    def authorized(self, user):
+        """ Honours the header of an API request once its `user` is authenticated """
+
+        if 'profile' not in g and self._requested(user):
+            self._start(False, True)
+
+    @staticmethod
+    def _after_request(response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+
+        profile.disable()
+        state = current_app.extensions['profiling']
+        name = state.save(profile, request.endpoint or 'unknown')
+        if g.profile_requested:
+            response.headers[state.header] = name
+
+        return response
+
+    @staticmethod
+    def _teardown_request(exc):
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.disable()
+
+
+profiler = RequestProfiler()
@@ -0,0 +1,98 @@
+import hashlib, json, os, bleach
+from multiprocessing import Pool
+from markdown import markdown
+from .cache import TTLCache
+
+
+# Bump whenever the output of the pipeline changes, cached html of older versions is not reused
+RENDERER_VERSION = 1
+
+POST_ALLOWED_TAGS = (
+    'a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'p',
+    'i', 'li', 'ol', 'pre', 'strong', 'ul', 'h1', 'h2', 'h3', 'h4'
+)
+
+COMMENT_ALLOWED_TAGS = ('a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong')
+
+render_cache = TTLCache(maxsize=4096)
+
+
+def _render(body, allowed_tags):
+    return bleach.linkify(bleach.clean(markdown(body, output_format='html'), tags=list(allowed_tags), strip=True))
+
+
+def render_html(body, allowed_tags):
+    """ Markdown to sanitized html, memoized by content hash and renderer version """
+
+    key = (hashlib.sha256(body.encode('utf-8')).hexdigest(), RENDERER_VERSION, allowed_tags)
+    html = render_cache.get(key)
+    if html is None:
+        html = _render(body, allowed_tags)
+        render_cache.set(key, html)
+
+    return html
+
+
+def _render_chunk(args):
+    rows, allowed_tags = args
+    return [(id, _render(body, allowed_tags)) for id, body in rows]
+
+
+def _load_state(state_file):
+    if state_file and os.path.exists(state_file):
+        with open(state_file) as f:
+            return json.load(f)
+
+    return {}
+
+
+def _save_state(state_file, state):
+    if state_file:
+        with open(state_file, 'w') as f:
+            json.dump(state, f)
+
+
+def rerender(chunk_size=1000, processes=None, state_file=None, echo=print):
+    """ Re-render body_html of all posts and comments across a process pool
+
+    Rows are read in id order in chunks of `chunk_size`, the last written id of every
+    table is stored in `state_file` after each batch so an interrupted run can resume.
+    """
+
+    from . import db
+    from .models import Post, Comment
+
+    state = _load_state(state_file)
+    processes = processes or os.cpu_count()
+    with Pool(processes) as pool:
+        window = chunk_size * processes * 2
+        for model, allowed_tags in ((Post, POST_ALLOWED_TAGS), (Comment, COMMENT_ALLOWED_TAGS)):
+            table = model.__table__
+            last_id = state.get(table.name, 0)
+            total = db.session.query(db.func.count(model.id)).filter(model.body.isnot(None)).scalar()
+            done = db.session.query(db.func.count(model.id)) \
+                .filter(model.body.isnot(None), model.id <= last_id).scalar()
+
+            while True:
+                rows = db.session.query(model.id, model.body) \
+                    .filter(model.body.isnot(None), model.id > last_id) \
+                    .order_by(model.id).limit(window).all()
+                if not rows:
+                    break
+
+                chunks = [(rows[i:i + chunk_size], allowed_tags) for i in range(0, len(rows), chunk_size)]
+                for rendered in pool.imap(_render_chunk, chunks):
+                    db.session.execute(
+                        table.update().where(table.c.id == db.bindparam('_id')).values(body_html=db.bindparam('_html')),
+                        [{ '_id': id, '_html': html } for id, html in rendered]
+                    )
+
+                db.session.commit()
+                last_id = rows[-1].id
+                done += len(rows)
+                state[table.name] = last_id
+                _save_state(state_file, state)
+                echo(f'{table.name}: {done}/{total}')
+
+    if state_file and os.path.exists(state_file):
+        os.remove(state_file)
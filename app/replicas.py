@@ -0,0 +1,233 @@
+import datetime, math, random, threading, time
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm, select
+from sqlalchemy.exc import SQLAlchemyError
+
+
+def _is_read(clause):
+    return clause is not None and getattr(clause, 'is_select', False) \
+        and getattr(clause, '_for_update_arg', None) is None
+
+
+def _mark_written(session):
+    session.info['wrote'] = True
+    if has_request_context():
+        g.replica_wrote = True
+
+
+class RoutingSession(SignallingSession):
+    """ Sends SELECTs of requests routed to a replica (`g.replica`) to that replica
+
+    Flushes, DML, locking reads and every statement after the session wrote go to the primary,
+    so a request always reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if clause is not None and getattr(clause, 'is_dml', False):
+            _mark_written(self)
+        elif not self._flushing and not self.info.get('wrote') and _is_read(clause) and has_app_context():
+            key = g.get('replica')
+            if key is not None:
+                return self.app.extensions['replicas'].engine(key)
+
+        return super().get_bind(mapper, clause)
+
+
+def after_flush(session, flush_context):
+    _mark_written(session)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, 'after_flush', after_flush)
+        return factory
+
+
+def read_primary(f):
+    """ Marks a GET view that writes, its reads never go to a replica """
+
+    f.read_primary = True
+    return f
+
+
+@contextmanager
+def primary():
+    """ Reads in the block go to the primary, for rows that fill caches shared between requests
+
+    A lagging replica would refill the identity and authentication caches with rows older
+    than the commit that just invalidated them.
+    """
+
+    if not has_app_context():
+        yield
+        return
+
+    replica = g.pop('replica', None)
+    try:
+        yield
+    finally:
+        g.replica = replica
+
+
+class _ReplicaState:
+    def __init__(self, app):
+        self.app = app
+        self.keys = [f'replica_{index}' for index in range(len(app.config['APP_READ_REPLICAS']))]
+        self.max_lag = app.config['APP_REPLICA_MAX_LAG']
+        self.interval = app.config['APP_REPLICA_LAG_INTERVAL']
+        self.cookie = app.config['APP_REPLICA_COOKIE']
+        # Seconds behind the primary, None until measured or while a replica is unreachable
+        self.lag = { key: None for key in self.keys }
+        self.engines = {}
+        self.last_check = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def engine(self, key=None):
+        engine = self.engines.get(key)
+        if engine is None:
+            engine = self.engines[key] = self.app.extensions['sqlalchemy'].db.get_engine(self.app, bind=key)
+
+        return engine
+
+    def check(self):
+        """ Rewrites the heartbeat on the primary and measures how old it is on every replica
+
+        A replica holding the previous heartbeat has replicated everything up to the last
+        check and counts as current, lag is measured at APP_REPLICA_LAG_INTERVAL resolution.
+        """
+
+        from .models import ReplicaHeartbeat
+
+        table = ReplicaHeartbeat.__table__
+        now = datetime.datetime.utcnow()
+        self.last_check = time.monotonic()
+        try:
+            with self.engine().begin() as connection:
+                last = connection.scalar(select(table.c.timestamp).where(table.c.id == 1))
+                if connection.execute(table.update().where(table.c.id == 1).values(timestamp=now)).rowcount == 0:
+                    connection.execute(table.insert().values(id=1, timestamp=now))
+        except SQLAlchemyError:
+            self.app.logger.exception('Could not write the replica heartbeat')
+            self.lag = { key: None for key in self.keys }
+            return
+
+        lag = {}
+        for key in self.keys:
+            try:
+                with self.engine(key).connect() as connection:
+                    seen = connection.scalar(select(table.c.timestamp).where(table.c.id == 1))
+            except SQLAlchemyError:
+                self.app.logger.exception(f'Could not read the heartbeat of {key}')
+                seen = None
+
+            if seen is None:
+                lag[key] = None
+            elif last is not None and seen >= last:
+                lag[key] = 0.0
+            else:
+                lag[key] = (now - seen).total_seconds()
+
+        self.lag = lag
+
+    def start(self):
+        """ Starts measuring the lag every APP_REPLICA_LAG_INTERVAL in a background thread
+
+        Called by requests so the thread runs in the worker process, requests never wait
+        for a check and an unreachable replica only delays the next measurement.
+        """
+
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopped.clear()
+                self.thread = threading.Thread(target=self._run, name='replica-lag', daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            if self.last_check is None or time.monotonic() - self.last_check >= self.interval:
+                try:
+                    self.check()
+                except Exception:
+                    self.app.logger.exception('Could not measure the replica lag')
+
+            if self.stopped.wait(max(self.interval - (time.monotonic() - self.last_check), 0.1)):
+                return
+
+    def pick(self):
+        """ Bind key of a random replica within APP_REPLICA_MAX_LAG, None when there is none """
+
+        current = [key for key, lag in self.lag.items() if lag is not None and lag <= self.max_lag]
+        return random.choice(current) if current else None
+
+    def sticky(self):
+        """ The client wrote within APP_REPLICA_MAX_LAG seconds, replicas may not have its rows yet """
+
+        try:
+            return float(request.cookies.get(self.cookie, 0)) > time.time()
+        except ValueError:
+            return False
+
+
+class ReadReplicas:
+    """ Routes the reads of GET requests to the replicas in APP_READ_REPLICAS
+
+    Every replica becomes the SQLALCHEMY_BINDS entry `replica_<n>`. Replicas lagging more
+    than APP_REPLICA_MAX_LAG are skipped. Responses to requests that wrote set a cookie
+    that keeps the client on the primary until the replicas caught up, views marked with
+    `read_primary` always read from the primary. The lag is measured by a background thread,
+    requests only look at the last measurement.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        state = _ReplicaState(app)
+        app.extensions['replicas'] = state
+        if not state.keys:
+            return
+
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds.update(zip(state.keys, app.config['APP_READ_REPLICAS']))
+        app.config['SQLALCHEMY_BINDS'] = binds
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    @property
+    def state(self) -> _ReplicaState:
+        return current_app.extensions['replicas']
+
+    @staticmethod
+    def _before_request():
+        state = current_app.extensions['replicas']
+        state.start()
+        g.replica, g.replica_wrote = None, False
+        view = current_app.view_functions.get(request.endpoint)
+        if request.method in ('GET', 'HEAD') and not getattr(view, 'read_primary', False) and not state.sticky():
+            g.replica = state.pick()
+
+    @staticmethod
+    def _after_request(response):
+        if g.get('replica_wrote'):
+            state = current_app.extensions['replicas']
+            response.set_cookie(state.cookie, f'{time.time() + state.max_lag:.3f}',
+                                max_age=math.ceil(state.max_lag), httponly=True)
+
+        return response
+
+
+replicas = ReadReplicas()
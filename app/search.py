@@ -0,0 +1,113 @@
+import re
+from sqlalchemy.dialects.mysql import match
+from . import db
+from .exceptions import ValidationError
+
+
+# Tables with a searchable `body`. MySQL keeps a FULLTEXT index on the column itself,
+# SQLite an FTS5 table `<table>_fts` whose rowid is the id of the indexed row.
+TABLES = ('posts', 'comments')
+
+
+def _with_table(name, dialect):
+    """ DDL condition, `dialect` is used and the metadata event covers the table `name` """
+
+    def condition(ddl, target, bind, tables=None, **kw):
+        return bind.dialect.name == dialect and name in { table.name for table in tables or () }
+
+    return condition
+
+
+for table in TABLES:
+    db.event.listen(db.Model.metadata, 'after_create', db.DDL(
+        f'CREATE FULLTEXT INDEX ix_{table}_body_fulltext ON {table} (body)').execute_if(callable_=_with_table(table, 'mysql')))
+    db.event.listen(db.Model.metadata, 'after_create', db.DDL(
+        f'CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(body)').execute_if(callable_=_with_table(table, 'sqlite')))
+    db.event.listen(db.Model.metadata, 'after_drop', db.DDL(
+        f'DROP TABLE IF EXISTS {table}_fts').execute_if(callable_=_with_table(table, 'sqlite')))
+
+
+def mark(target):
+    """ Called by the `set` listeners of `body`, the row is reindexed by the next flush """
+
+    target._search_pending = True
+
+
+def _terms(q):
+    terms = re.findall(r'\w+', q or '')
+    if not terms:
+        raise ValidationError('Search query does not have any words')
+
+    return terms
+
+
+def _ranked_mysql(model, terms):
+    score = match(model.body, against=' '.join(terms)).in_natural_language_mode()
+    return db.select(model.id.label('id'), score.label('score')).where(score > 0)
+
+
+def _ranked_sqlite(model, terms):
+    fts = f'{model.__tablename__}_fts'
+    # Quoted terms are matched literally, bm25 is lower for better matches
+    return db.select(db.literal_column('rowid').label('id'), db.literal_column(f'-bm25({fts})').label('score')) \
+        .select_from(db.table(fts)) \
+        .where(db.text(f'{fts} MATCH :terms').bindparams(terms=' OR '.join(f'"{term}"' for term in terms)))
+
+
+def search(model, q):
+    """ Returns (query, columns), rows of `model` matching `q` as (model, score, id),
+    `columns` orders them by relevance for CursorPagination
+
+    Cursors over search results are best effort: scores are recomputed for every page and
+    change as rows are reindexed (MySQL relevance depends on the whole index), so a result
+    can be skipped or repeated when the index changes between two pages.
+    """
+
+    ranked = { 'mysql': _ranked_mysql, 'sqlite': _ranked_sqlite }.get(db.engine.dialect.name)
+    if ranked is None:
+        raise RuntimeError(f'Full-text search on {db.engine.dialect.name} is not supported')
+
+    ranked = ranked(model, _terms(q)).subquery('ranked')
+    query = db.session.query(model, ranked.c.score, ranked.c.id).join(ranked, ranked.c.id == model.id)
+    return query, (ranked.c.score, ranked.c.id)
+
+
+def _index(connection, obj):
+    fts = f'{obj.__table__.name}_fts'
+    connection.execute(db.text(f'DELETE FROM {fts} WHERE rowid = :id'), { 'id': obj.id })
+    if obj.body is not None:
+        connection.execute(db.text(f'INSERT INTO {fts} (rowid, body) VALUES (:id, :body)'),
+                           { 'id': obj.id, 'body': obj.body })
+
+
+def _unindex(connection, obj):
+    connection.execute(db.text(f'DELETE FROM {obj.__table__.name}_fts WHERE rowid = :id'), { 'id': obj.id })
+
+
+def rebuild():
+    """ Refills the FTS5 tables, for rows written without the ORM. MySQL needs nothing. """
+
+    connection = db.session.connection()
+    if connection.dialect.name != 'sqlite':
+        return
+
+    for table in TABLES:
+        connection.execute(db.text(f'DELETE FROM {table}_fts'))
+        connection.execute(db.text(f'INSERT INTO {table}_fts (rowid, body) '
+                                   f'SELECT id, body FROM {table} WHERE body IS NOT NULL'))
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def after_flush(session, flush_context):
+    # Ids of new rows are known only after the flush, the FTS rows go into the same transaction
+    connection = session.connection()
+    if connection.dialect.name != 'sqlite':
+        return
+
+    for obj in list(session.new) + list(session.dirty):
+        if obj.__dict__.pop('_search_pending', False) and getattr(obj, '__tablename__', None) in TABLES:
+            _index(connection, obj)
+
+    for obj in session.deleted:
+        if getattr(obj, '__tablename__', None) in TABLES:
+            _unindex(connection, obj)
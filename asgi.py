@@ -0,0 +1,6 @@
+from os import getenv
+from app.asgi import create_asgi_app
+
+
+# uvicorn asgi:app, serves the read-only API endpoints only
+app = create_asgi_app(getenv('FLASK_CONFIG') or 'default')
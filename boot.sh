@@ -11,4 +11,9 @@ while true; do
   sleep 5
 done
 
+# Counters of the previous run would be added to the new workers' ones
+if [ -n "$APP_METRICS_DIR" ]; then
+  rm -f "$APP_METRICS_DIR"/metrics-*.json
+fi
+
 exec gunicorn -b :5000 --access-logfile - --error-logfile - main:app
@@ -31,6 +31,50 @@ class Config:
     APP_FOLLOWERS_PER_PAGE=10
     APP_COMMENTS_PER_PAGE=10
     APP_SLOW_DB_QUERY_TIME = 0.5
+    APP_QUERY_LOG = os.getenv('APP_QUERY_LOG')
+    APP_TIMELINE_FANOUT_LIMIT = 1000
+    APP_TIMELINE_BACKFILL = 200
+    APP_COUNT_CACHE_SIZE = 1024
+    APP_COUNT_CACHE_TTL = 60
+    APP_API_COUNT_MODE = 'exact'
+    APP_PAGE_COUNT_MODE = 'none'
+    APP_LAST_SEEN_INTERVAL = 60
+    APP_LAST_SEEN_FLUSH_INTERVAL = 10
+    APP_LAST_SEEN_BATCH_SIZE = 500
+    APP_PAGE_CACHE = False
+    APP_PAGE_CACHE_TTL = 300
+    APP_PAGE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+    APP_IDENTITY_CACHE_SIZE = 4096
+    APP_IDENTITY_CACHE_TTL = 60
+    APP_TOKEN_CACHE_SIZE = 10000
+    APP_TOKEN_CACHE_TTL = 300
+    APP_CREDENTIALS_CACHE_SIZE = 1000
+    APP_CREDENTIALS_CACHE_TTL = 300
+    APP_HASHING_PROCESSES = 2
+    APP_HASHING_QUEUE_SIZE = 32
+    APP_HASHING_TIMEOUT = 5
+    APP_MAIL_WORKERS = 4
+    APP_MAIL_BATCH_SIZE = 50
+    APP_MAIL_MAX_RETRIES = 5
+    APP_MAIL_RETRY_BACKOFF = 1
+    APP_MAIL_IDLE_TIMEOUT = 30
+    APP_MAIL_FLUSH_TIMEOUT = 10
+    APP_METRICS_DIR = os.getenv('APP_METRICS_DIR')
+    APP_METRICS_FLUSH_INTERVAL = 5
+    APP_METRICS_TOKEN = os.getenv('APP_METRICS_TOKEN')
+    APP_PROFILE_DIR = os.getenv('APP_PROFILE_DIR') or os.path.join(basedir, 'tmp/profiles')
+    APP_PROFILE_SAMPLE_RATE = float(os.getenv('APP_PROFILE_SAMPLE_RATE') or 0)
+    APP_PROFILE_HEADER = 'X-Profile'
+    APP_PROFILE_KEEP = 100
+    APP_READ_REPLICAS = [uri for uri in (os.getenv('APP_READ_REPLICAS') or '').split(',') if uri]
+    APP_REPLICA_MAX_LAG = 5
+    APP_REPLICA_LAG_INTERVAL = 1
+    APP_REPLICA_COOKIE = 'read_primary_until'
+    APP_ASYNC_DATABASE_URI = os.getenv('ASYNC_DATABASE_URL')
+    APP_ASYNC_POOL_SIZE = 50
+    APP_EXPORT_BATCH_SIZE = 1000
+    APP_API_MAX_BATCH = 100
+    APP_API_MAX_PER_PAGE = 100
 
     @staticmethod
     def init_app(app):
@@ -46,6 +90,14 @@ class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = DATABASE_TEST_URI
     WTF_CSRF_ENABLED = False
+    APP_LAST_SEEN_FLUSH_INTERVAL = 0
+    APP_HASHING_PROCESSES = 0
+    APP_MAIL_IDLE_TIMEOUT = 1
+
+
+class BenchConfig(Config):
+    # A database of its own, `flask bench` seeds it when empty and drops what it created
+    SQLALCHEMY_DATABASE_URI = os.getenv('BENCH_DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'bench.sqlite')
 
 
 class ProductionConfig(Config):
@@ -93,6 +145,7 @@ class DockerConfig(ProductionConfig):
 config = {
     'development': DevelopmentConfig,
     'testing': TestingConfig,
+    'bench': BenchConfig,
     'production': ProductionConfig,
     'docker': DockerConfig,
     'default': DevelopmentConfig
@@ -1,7 +1,7 @@
 import sys, click
-from os import getenv, environ, execvp, path
+from os import getenv, environ, execvp, path, remove
 from app import create_app, db
-from app.models import User, Role
+from app.models import User, Role, Post
 from flask_migrate import Migrate, upgrade
 
 
@@ -14,11 +14,6 @@ if environ.get('FLASK_COVERAGE'):
 app = create_app(getenv('FLASK_CONFIG') or 'default')
 migrate = Migrate(app, db)
 
-# -------- Profiler --------
-# from werkzeug.middleware.profiler import ProfilerMiddleware
-# app.wsgi_app = ProfilerMiddleware(app.wsgi_app, restrictions = [30])
-# --------------------------
-
 @app.shell_context_processor
 def make_shell_context():
     return dict(db=db, User=User, Role=Role)
@@ -47,13 +42,114 @@ def test(coverage) -> None:
         COV.erase()
 
 
-# @app.cli.command()
-# @click.option('--length', default=25, help='Number of function used in profiler report')
-# @click.option('--profile-dir', default=None, help='Directory where report data are saved')
-# def profile(length, profile_dir):
-#     from werkzeug.middleware.profiler import ProfilerMiddleware
-#     app.wsgi_app = ProfilerMiddleware(app.wsgi_app, restrictions=[length], profile_dir=profile_dir)
-#     app.run(debug=False)
+@app.cli.command()
+@click.option('--length', default=25, help='Number of function used in profiler report')
+@click.option('--profile-dir', default=None, help='Directory where report data are saved')
+@click.option('--requests', default=0, help='Profile this many in-process requests per endpoint instead of serving the app')
+def profile(length, profile_dir, requests):
+    """ Profile every request, one .prof and .collapsed file per endpoint """
+
+    state = app.extensions['profiling']
+    state.aggregate = True
+    state.sample_rate = 1.0
+    if profile_dir:
+        state.directory = profile_dir
+
+    if requests:
+        from app.bench import run, targets
+        with app.app_context():
+            run(app, targets(app), requests=requests, warmup=0, echo=click.echo)
+    else:
+        app.run(debug=False)
+
+    for endpoint, stats in sorted(state.endpoint_stats.items()):
+        click.echo(f'-------- {endpoint} --------')
+        stats.sort_stats('cumulative').print_stats(length)
+
+    click.echo(f'Profiles saved in {state.directory}')
+
+
+@app.cli.command()
+def recount():
+    """ Repair drift of the denormalized counter columns """
+
+    User.recount_counters()
+    Post.recount_counters()
+    db.session.commit()
+
+
+@app.cli.command()
+@click.option('--chunk-size', default=1000, help='Number of rows rendered by a worker at once')
+@click.option('--processes', default=None, type=int, help='Number of worker processes, defaults to the CPU count')
+@click.option('--state-file', default='.rerender-state.json', help='File storing progress, used to resume a run')
+@click.option('--restart/--resume', default=False, help='Ignore the progress stored by an interrupted run')
+def rerender(chunk_size, processes, state_file, restart):
+    """ Re-render body_html of all posts and comments """
+
+    from app.render import rerender
+    if restart and path.exists(state_file):
+        remove(state_file)
+
+    rerender(chunk_size=chunk_size, processes=processes, state_file=state_file, echo=click.echo)
+
+
+@app.cli.command()
+@click.option('--users', default=1000, help='Number of users to add')
+@click.option('--posts', default=10000, help='Number of posts to add')
+@click.option('--comments', default=20000, help='Number of comments to add')
+@click.option('--follows', default=20, help='Mean number of users followed by a new user')
+@click.option('--seed', 'seed_', default=0, help='Random seed, the same seed gives the same data')
+@click.option('--password', default='test', help='Password shared by all new users')
+@click.option('--chunk-size', default=10000, help='Number of rows generated and inserted at once')
+@click.option('--processes', default=None, type=int, help='Number of worker processes, defaults to the CPU count')
+def seed(users, posts, comments, follows, seed_, password, chunk_size, processes):
+    """ Fill the database with generated data for load testing """
+
+    from app.fake import seed
+    seed(users=users, posts=posts, comments=comments, follows=follows, seed=seed_,
+         password=password, chunk_size=chunk_size, processes=processes, echo=click.echo)
+
+
+@app.cli.command()
+@click.option('--config', 'config_name', default='bench', help='Configuration of the benchmarked app')
+@click.option('--users', default=200, help='Number of users seeded into an empty database')
+@click.option('--posts', default=2000, help='Number of posts seeded into an empty database')
+@click.option('--comments', default=4000, help='Number of comments seeded into an empty database')
+@click.option('--follows', default=20, help='Mean number of users followed by a seeded user')
+@click.option('--password', default='test', help='Password of the user sending API requests')
+@click.option('--requests', default=100, help='Number of timed requests per endpoint')
+@click.option('--warmup', default=10, help='Number of untimed requests per endpoint')
+@click.option('--baseline', default=None, help='JSON file with results to compare against')
+@click.option('--save-baseline', is_flag=True, default=False, help='Store the results in the baseline file')
+@click.option('--tolerance', default=0.2, help='Allowed relative drift of latency and throughput')
+def bench(config_name, users, posts, comments, follows, password, requests, warmup, baseline, save_baseline, tolerance):
+    """ Benchmark the main pages and the API in-process, fails on regressions """
+
+    from app.bench import bench
+    regressions = bench(create_app(config_name), users=users, posts=posts, comments=comments, follows=follows,
+                        password=password, requests=requests, warmup=warmup, baseline=baseline,
+                        save_baseline=save_baseline, tolerance=tolerance, echo=click.echo)
+    for regression in regressions:
+        click.echo(f'Regression: {regression}', err=True)
+
+    if regressions:
+        sys.exit(1)
+
+
+@app.cli.command('index-advisor')
+@click.option('--log', default=None, help='Query log written while APP_QUERY_LOG was set, defaults to APP_QUERY_LOG')
+def index_advisor(log):
+    """ EXPLAIN the logged statements and report full scans and filesorts """
+
+    from app.index_advisor import advise
+    log = log or app.config['APP_QUERY_LOG']
+    if not log:
+        raise click.UsageError('Run the tests or flask bench with APP_QUERY_LOG set, then pass the log with --log')
+
+    with app.app_context():
+        flagged = advise(log, echo=click.echo)
+
+    click.echo(f'{flagged} statements could use an index')
 
 
 @app.cli.command()
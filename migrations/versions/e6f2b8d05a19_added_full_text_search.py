@@ -0,0 +1,35 @@
+"""Added full-text search
+
+Revision ID: e6f2b8d05a19
+Revises: d4e7a91c3b58
+Create Date: 2026-10-18 16:02:44.917206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6f2b8d05a19'
+down_revision = 'd4e7a91c3b58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table in ('posts', 'comments'):
+        if dialect == 'mysql':
+            op.create_index(f'ix_{table}_body_fulltext', table, ['body'], unique=False, mysql_prefix='FULLTEXT')
+        elif dialect == 'sqlite':
+            op.execute(f'CREATE VIRTUAL TABLE {table}_fts USING fts5(body)')
+            op.execute(f'INSERT INTO {table}_fts (rowid, body) SELECT id, body FROM {table} WHERE body IS NOT NULL')
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table in ('comments', 'posts'):
+        if dialect == 'mysql':
+            op.drop_index(f'ix_{table}_body_fulltext', table_name=table)
+        elif dialect == 'sqlite':
+            op.execute(f'DROP TABLE {table}_fts')
@@ -2,6 +2,8 @@ import unittest
 import json
 import re
 from base64 import b64encode
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
 from app import create_app, db
 from app.models import User, Role, Post, Comment
 
@@ -269,3 +271,322 @@ class APITestCase(unittest.TestCase):
         json_response = json.loads(response.get_data(as_text=True))
         self.assertIsNotNone(json_response.get('comments'))
         self.assertEqual(json_response.get('count', 0), 2)
+
+    def test_posts_cursor_pagination(self):
+        # add a user with posts, some of them sharing a timestamp
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True, role=r)
+        db.session.add(u)
+        start = datetime(2022, 1, 1)
+        posts = [Post(body=f'post {i}', author=u, timestamp=start + timedelta(minutes=i // 2)) for i in range(25)]
+        db.session.add_all(posts)
+        db.session.commit()
+        expected = [p.id for p in sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)]
+
+        # walk forwards through all the pages
+        urls, ids = [], []
+        url = '/api/v1/posts/'
+        while url:
+            response = self.client.get(url, headers=self.get_api_headers('john@example.com', 'cat'))
+            self.assertEqual(response.status_code, 200)
+            json_response = json.loads(response.get_data(as_text=True))
+            self.assertEqual(json_response['count'], 25)
+            ids.extend(int(post['url'].rsplit('/', 1)[-1]) for post in json_response['posts'])
+            urls.append(url)
+            url = json_response['next']
+
+        self.assertEqual(ids, expected)
+        self.assertEqual(len(urls), 3)
+
+        # and back from the last page
+        response = self.client.get(urls[-1], headers=self.get_api_headers('john@example.com', 'cat'))
+        json_response = json.loads(response.get_data(as_text=True))
+        response = self.client.get(json_response['prev'], headers=self.get_api_headers('john@example.com', 'cat'))
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual([int(post['url'].rsplit('/', 1)[-1]) for post in json_response['posts']], expected[10:20])
+
+        # bad cursors are rejected
+        response = self.client.get('/api/v1/posts/?cursor=bad', headers=self.get_api_headers('john@example.com', 'cat'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_count_modes(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True, role=r)
+        db.session.add_all([u, Post(body='first', author=u)])
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        response = self.client.get('/api/v1/posts/', headers=headers)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['count'], 1)
+
+        # the cached count is invalidated by inserts
+        db.session.add(Post(body='second', author=u))
+        db.session.commit()
+        response = self.client.get('/api/v1/posts/?count=exact', headers=headers)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['count'], 2)
+        response = self.client.get('/api/v1/posts/?count=estimate', headers=headers)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['count'], 2)
+        response = self.client.get('/api/v1/posts/?count=none', headers=headers)
+        self.assertIsNone(json.loads(response.get_data(as_text=True))['count'])
+        response = self.client.get('/api/v1/posts/?count=wrong', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_timeline_count(self):
+        r = Role.query.filter_by(name='User').first()
+        u1 = User(email='john@example.com', password='cat', confirmed=True, role=r)
+        u2 = User(email='susan@example.com', password='dog', confirmed=True, role=r)
+        db.session.add_all([u1, u2, Post(body='first', author=u1),
+                            Post(body='second', author=u2), Post(body='third', author=u2)])
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+        url = '/api/v1/users/{}/timeline/?count=exact'.format(u1.id)
+
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['count'], 1)
+
+        # the cached count is invalidated by timeline rows following and unfollowing write
+        u1.follow(u2)
+        db.session.commit()
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['count'], 3)
+        u1.unfollow(u2)
+        db.session.commit()
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['count'], 1)
+
+    def test_token_cache(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        response = self.client.post('/api/v1/tokens/', headers=self.get_api_headers('john@example.com', 'cat'))
+        token = json.loads(response.get_data(as_text=True))['token']
+        response = self.client.get('/api/v1/users/{}'.format(u.id), headers=self.get_api_headers(token, ''))
+        self.assertEqual(response.status_code, 200)
+
+        # repeated tokens are verified without the database
+        from app.api.authentication import verify_token
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.test_request_context('/'):
+            db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+            try:
+                user = verify_token(token)
+                self.assertTrue(user.confirmed)
+                self.assertEqual(user.id, u.id)
+            finally:
+                db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertEqual(statements, [])
+
+        # and invalidated when the user changes
+        u.confirmed = False
+        db.session.add(u)
+        db.session.commit()
+        response = self.client.get('/api/v1/users/{}'.format(u.id), headers=self.get_api_headers(token, ''))
+        self.assertEqual(response.status_code, 403)
+
+    def test_credentials_cache(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        response = self.client.get('/api/v1/posts/', headers=self.get_api_headers('john@example.com', 'cat'))
+        self.assertEqual(response.status_code, 200)
+        stats = self.app.extensions['credentials_cache'].stats()
+        self.assertEqual(stats['misses'], 1)
+
+        # repeated credentials skip the password hash
+        response = self.client.get('/api/v1/posts/', headers=self.get_api_headers('john@example.com', 'cat'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.app.extensions['credentials_cache'].stats()['hits'], 1)
+
+        # a wrong password is never served from the cache
+        response = self.client.get('/api/v1/posts/', headers=self.get_api_headers('john@example.com', 'dog'))
+        self.assertEqual(response.status_code, 401)
+
+        # and changing the password drops cached credentials
+        u.password = 'dog'
+        db.session.add(u)
+        db.session.commit()
+        response = self.client.get('/api/v1/posts/', headers=self.get_api_headers('john@example.com', 'cat'))
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get('/api/v1/posts/', headers=self.get_api_headers('john@example.com', 'dog'))
+        self.assertEqual(response.status_code, 200)
+
+        # also when another worker changed it
+        db.session.execute(User.__table__.update().where(User.id == u.id)
+                           .values(password_hash=generate_password_hash('cow')))
+        db.session.commit()
+        db.session.remove()
+        response = self.client.get('/api/v1/posts/', headers=self.get_api_headers('john@example.com', 'dog'))
+        self.assertEqual(response.status_code, 401)
+
+    def test_search(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True, role=r)
+        db.session.add(u)
+        posts = [Post(body=f'flask post {i}', author=u) for i in range(14)]
+        best = Post(body='flask flask flask', author=u)
+        other = Post(body='nothing to see', author=u)
+        db.session.add_all(posts + [best, other])
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        # the best match comes first, every match is seen once across the pages
+        ids = []
+        url = '/api/v1/search?q=Flask!'
+        while url:
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            json_response = json.loads(response.get_data(as_text=True))
+            self.assertEqual(json_response['count'], 15)
+            scores = [post['score'] for post in json_response['posts']]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+            ids.extend(int(post['url'].rsplit('/', 1)[-1]) for post in json_response['posts'])
+            url = json_response['next']
+
+        self.assertEqual(ids[0], best.id)
+        self.assertEqual(sorted(ids), sorted(p.id for p in posts + [best]))
+
+        # edits and deletes are reindexed
+        other.body = 'now about flask'
+        db.session.delete(best)
+        db.session.commit()
+        response = self.client.get('/api/v1/search?q=flask&count=none', headers=headers)
+        json_response = json.loads(response.get_data(as_text=True))
+        ids = [int(post['url'].rsplit('/', 1)[-1]) for post in json_response['posts']]
+        self.assertIn(other.id, ids)
+        self.assertNotIn(best.id, ids)
+
+        # blocked comments are not found
+        db.session.add_all([Comment(body='good comment', author=u, post=other),
+                            Comment(body='blocked comment', author=u, post=other, disabled=True)])
+        db.session.commit()
+        response = self.client.get('/api/v1/search?q=comment&type=comments', headers=headers)
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual([comment['body'] for comment in json_response['comments']], ['good comment'])
+
+        # queries without words and unknown types are rejected
+        response = self.client.get('/api/v1/search?q=%22*', headers=headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/v1/search?q=flask&type=users', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_export(self):
+        r = Role.query.filter_by(name='User').first()
+        john = User(email='john@example.com', password='cat', confirmed=True, role=r)
+        susan = User(email='susan@example.com', password='dog', confirmed=True, role=r)
+        now = datetime.utcnow()
+        posts = [Post(body=f'post {i}', author=john, timestamp=now - timedelta(days=i)) for i in range(5)]
+        db.session.add_all(posts + [Post(body='susan post', author=susan, timestamp=now)])
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        # one line per post, oldest first
+        response = self.client.get('/api/v1/users/{}/posts/export'.format(john.id), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([line['body'] for line in lines], [f'post {i}' for i in reversed(range(5))])
+        self.assertEqual(lines[0], json.loads(self.client.get(lines[0]['url'], headers=headers).get_data(as_text=True)))
+
+        response = self.client.get('/api/v1/posts/export', headers=headers)
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 6)
+
+        # since filters by timestamp, both ISO 8601 and the serialized form are understood
+        since = (now - timedelta(days=1, hours=1)).isoformat()
+        response = self.client.get(f'/api/v1/users/{john.id}/posts/export?since={since}', headers=headers)
+        self.assertEqual([json.loads(line)['body'] for line in response.get_data(as_text=True).splitlines()],
+                         ['post 1', 'post 0'])
+        response = self.client.get('/api/v1/posts/export', headers=headers,
+                                   query_string={ 'since': lines[3]['timestamp'] })
+        self.assertEqual(len(response.get_data(as_text=True).splitlines()), 3)
+
+        response = self.client.get('/api/v1/posts/export?since=yesterday', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_batches(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        # valid items are created together, invalid ones are answered one by one
+        response = self.client.post('/api/v1/posts/', headers=headers,
+                                    data=json.dumps([{ 'body': 'first' }, { 'body': '' }, 'third', { 'body': 'fourth' }]))
+        self.assertEqual(response.status_code, 201)
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(json_response['created'], 2)
+        self.assertEqual([result['status'] for result in json_response['results']], [201, 400, 400, 201])
+        self.assertEqual(json_response['results'][3]['post']['body'], 'fourth')
+        self.assertEqual(u.posts.count(), 2)
+        ids = [int(result['location'].rsplit('/', 1)[-1]) for result in json_response['results'] if result['status'] == 201]
+
+        response = self.client.post(f'/api/v1/posts/{ids[0]}/comments/', headers=headers,
+                                    data=json.dumps([{ 'body': 'a comment' }, { 'body': 'another comment' }]))
+        self.assertEqual(response.status_code, 201)
+        comment_ids = [int(result['location'].rsplit('/', 1)[-1]) for result in json.loads(
+            response.get_data(as_text=True))['results']]
+        self.assertEqual(Post.query.get(ids[0]).comment_count, 2)
+
+        # reads keep the requested order and list unknown ids
+        response = self.client.get('/api/v1/posts/?ids={},12345,{}'.format(ids[1], ids[0]), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual([post['body'] for post in json_response['posts']], ['fourth', 'first'])
+        self.assertEqual(json_response['missing'], [12345])
+
+        response = self.client.get('/api/v1/comments/?ids={},{}'.format(*reversed(comment_ids)), headers=headers)
+        self.assertEqual([comment['body'] for comment in json.loads(response.get_data(as_text=True))['comments']],
+                         ['another comment', 'a comment'])
+
+        # batches are capped and ids have to be numbers
+        self.app.config['APP_API_MAX_BATCH'] = 2
+        response = self.client.get('/api/v1/posts/?ids=1,2,3', headers=headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/v1/posts/', headers=headers, data=json.dumps([{ 'body': 'x' }] * 3))
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/v1/posts/?ids=1,a', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_fields_and_page_size(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', username='john', password='cat', confirmed=True, role=r)
+        now = datetime.utcnow()
+        db.session.add_all([u] + [Post(body=f'post {i}', author=u, timestamp=now - timedelta(minutes=i))
+                                  for i in range(7)])
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        # only the requested fields are returned
+        response = self.client.get('/api/v1/users/{}?fields=username,post_count'.format(u.id), headers=headers)
+        self.assertEqual(json.loads(response.get_data(as_text=True)), { 'username': 'john', 'post_count': 7 })
+        response = self.client.get('/api/v1/users/{}/posts/?fields=id,body'.format(u.id), headers=headers)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['posts'][0],
+                         { 'id': u.posts.order_by(Post.timestamp.desc()).first().id, 'body': 'post 0' })
+
+        # per_page sets the page size, the links keep it and the fields
+        url = '/api/v1/posts/?per_page=3&fields=url,body,unknown'
+        pages = []
+        while url:
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            json_response = json.loads(response.get_data(as_text=True))
+            self.assertTrue(all(set(post) == { 'url', 'body' } for post in json_response['posts']))
+            pages.append([post['body'] for post in json_response['posts']])
+            url = json_response['next']
+
+        self.assertEqual(pages, [['post 0', 'post 1', 'post 2'], ['post 3', 'post 4', 'post 5'], ['post 6']])
+
+        # page sizes are capped and have to be positive integers
+        self.app.config['APP_API_MAX_PER_PAGE'] = 5
+        response = self.client.get('/api/v1/posts/?per_page=50', headers=headers)
+        self.assertEqual(len(json.loads(response.get_data(as_text=True))['posts']), 5)
+        response = self.client.get('/api/v1/posts/?per_page=0', headers=headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/v1/posts/?per_page=all', headers=headers)
+        self.assertEqual(response.status_code, 400)
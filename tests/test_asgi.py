@@ -0,0 +1,102 @@
+import unittest, asyncio, datetime, json, os, shutil, tempfile
+from base64 import b64encode
+from app import create_app, db
+from app.asgi import AsyncReadAPI
+from app.models import User, Role, Post, Comment
+from config import config, TestingConfig
+
+
+class AsyncReadAPITestCase(unittest.TestCase):
+    def setUp(self):
+        # The async engine needs its own connections to the same database, so a file
+        self.directory = tempfile.mkdtemp()
+        config['asgi'] = type('AsgiTestingConfig', (TestingConfig,), {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(self.directory, 'test.sqlite')
+        })
+
+        self.app = create_app('asgi')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client()
+        self.asgi = AsyncReadAPI(self.app)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.asgi.engine.dispose())
+        self.loop.close()
+        db.session.remove()
+        db.drop_all()
+        db.get_engine(self.app).dispose()
+        self.app_context.pop()
+        del config['asgi']
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def get_api_headers(self, username, password):
+        return {
+            'Authorization': 'Basic ' + b64encode(
+                (username + ':' + password).encode('utf-8')).decode('utf-8'),
+            'Accept': 'application/json'
+        }
+
+    async def request(self, url, headers):
+        path, _, query_string = url.partition('?')
+        messages = []
+        async def receive():
+            return { 'type': 'http.request', 'body': b'', 'more_body': False }
+
+        async def send(message):
+            messages.append(message)
+
+        await self.asgi({
+            'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string.encode('latin-1'),
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers.items()]
+        }, receive, send)
+        return messages[0]['status'], json.loads(messages[1]['body'])
+
+    def get(self, url, headers):
+        return self.loop.run_until_complete(self.request(url, headers))
+
+    def test_same_responses(self):
+        r = Role.query.filter_by(name='User').first()
+        john = User(email='john@example.com', username='john', password='cat', confirmed=True, role=r)
+        susan = User(email='susan@example.com', username='susan', password='dog', confirmed=True, role=r)
+        db.session.add_all([john, susan])
+        db.session.commit()
+        john.follow(susan)
+        # SQLite's server default has whole seconds only, rows from one second would share a cursor key
+        now = datetime.datetime.utcnow()
+        posts = [Post(body=f'post {i}', author=susan, timestamp=now - datetime.timedelta(minutes=i)) for i in range(12)]
+        db.session.add_all(posts + [Comment(body='comment', author=john, post=posts[0])])
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        # every endpoint answers like the WSGI app, pages included
+        for url in ('/api/v1/posts/', f'/api/v1/posts/{posts[0].id}', f'/api/v1/users/{john.id}',
+                    f'/api/v1/users/{susan.id}/posts/', f'/api/v1/users/{john.id}/timeline/',
+                    '/api/v1/comments/', f'/api/v1/posts/?ids={posts[3].id},12345,{posts[1].id}',
+                    f'/api/v1/users/{susan.id}/posts/?per_page=5&fields=url,body', f'/api/v1/users/{john.id}?fields=username'):
+            while url:
+                response = self.client.get(url, headers=headers)
+                status, body = self.get(url, headers)
+                self.assertEqual(status, 200)
+                self.assertEqual(body, json.loads(response.get_data(as_text=True)))
+                url = body.get('next')
+
+        # concurrent requests share the caches and the connection pool
+        async def many():
+            return await asyncio.gather(*(self.request('/api/v1/posts/', headers) for _ in range(20)))
+
+        self.assertTrue(all(status == 200 for status, _ in self.loop.run_until_complete(many())))
+
+        # and the API errors are the same too
+        self.assertEqual(self.get('/api/v1/posts/', self.get_api_headers('john@example.com', 'dog'))[0], 401)
+        self.assertEqual(self.get('/api/v1/posts/12345', headers)[0], 404)
+        self.assertEqual(self.get('/api/v1/posts/?cursor=bad', headers)[0], 400)
+        self.assertEqual(self.get('/auth/login', headers)[0], 404)
+
+        # tokens issued by the WSGI app are accepted
+        response = self.client.post('/api/v1/tokens/', headers=headers)
+        token = json.loads(response.get_data(as_text=True))['token']
+        self.assertEqual(self.get(f'/api/v1/users/{susan.id}', self.get_api_headers(token, ''))[0], 200)
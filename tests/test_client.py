@@ -1,6 +1,9 @@
-import unittest, re
+import unittest, re, os, json, tempfile
+from base64 import b64encode
+from unittest import mock
 from app import create_app, db
-from app.models import User, Role
+from app.models import User, Role, Post, Comment
+from app.last_seen import last_seen
 
 
 class FlaskClientTestCase(unittest.TestCase):
@@ -55,3 +58,208 @@ class FlaskClientTestCase(unittest.TestCase):
         response = self.client.get('/auth/logout', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
         self.assertTrue('You have been logged out' in response.get_data(as_text=True))
+
+    def count_queries(self, url):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get(url)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertEqual(response.status_code, 200)
+        return len(statements)
+
+    def add_posts(self, count):
+        offset = User.query.count()
+        for i in range(offset, offset + count):
+            u = User(email=f'user{i}@gmail.com', username=f'user{i}', password='test')
+            p = Post(body=f'post {i}', author=u)
+            db.session.add_all([u, p, Comment(body='comment', author=u, post=p)])
+
+        db.session.commit()
+
+    def test_list_queries_do_not_grow_with_items(self):
+        self.add_posts(2)
+        few = self.count_queries('/')
+        post_few = self.count_queries('/post/1')
+        self.add_posts(8)
+        for u in User.query.all():
+            db.session.add(Comment(body='another comment', author=u, post=Post.query.get(1)))
+
+        db.session.commit()
+        self.assertEqual(self.count_queries('/'), few)
+        self.assertEqual(self.count_queries('/post/1'), post_few)
+
+    def test_page_cache(self):
+        self.app.config['APP_PAGE_CACHE'] = True
+        self.add_posts(2)
+        self.assertEqual(self.client.get('/').headers['X-Page-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/').headers['X-Page-Cache'], 'HIT')
+        self.assertEqual(self.client.get('/user/user1').headers['X-Page-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/post/1').headers['X-Page-Cache'], 'MISS')
+
+        # a comment on the first post only drops the pages showing that post
+        db.session.add(Comment(body='new comment', author=User.query.get(2), post=Post.query.get(1)))
+        db.session.commit()
+        self.assertEqual(self.client.get('/user/user1').headers['X-Page-Cache'], 'HIT')
+        response = self.client.get('/post/1')
+        self.assertEqual(response.headers['X-Page-Cache'], 'MISS')
+        self.assertTrue('new comment' in response.get_data(as_text=True))
+
+        # a buffered last_seen flush drops the profile
+        self.assertEqual(self.client.get('/user/user1').headers['X-Page-Cache'], 'HIT')
+        last_seen.touch(User.query.filter_by(username='user1').first().id)
+        last_seen.flush()
+        self.assertEqual(self.client.get('/user/user1').headers['X-Page-Cache'], 'MISS')
+
+        # a new post drops the index
+        db.session.add(Post(body='brand new post', author=User.query.get(2)))
+        db.session.commit()
+        response = self.client.get('/')
+        self.assertEqual(response.headers['X-Page-Cache'], 'MISS')
+        self.assertTrue('brand new post' in response.get_data(as_text=True))
+
+    def test_search(self):
+        self.add_posts(2)
+        db.session.add(Post(body='a post about *search*', author=User.query.get(2)))
+        db.session.commit()
+        response = self.client.get('/search?q=search')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_data(as_text=True)
+        self.assertTrue('<em>search</em>' in data)
+        self.assertFalse('post 1' in data)
+
+        response = self.client.get('/search?q=nothing')
+        self.assertTrue('Nothing matches' in response.get_data(as_text=True))
+
+    def test_bench(self):
+        from app.bench import bench, compare
+        db.drop_all()
+        lines = []
+        self.assertEqual(bench(self.app, users=10, posts=30, comments=30, follows=3, requests=2, warmup=0,
+                               echo=lines.append), [])
+        self.assertTrue(any(line.startswith('main.index') for line in lines))
+        self.assertTrue(any(line.startswith('api.get_post_comments') for line in lines))
+        # the tables it created are gone again
+        self.assertFalse(db.inspect(db.engine).has_table('posts'))
+
+        # existing tables are kept, endpoints without a row to point at are skipped
+        db.create_all()
+        self.app.add_url_rule('/api/v1/roles/<int:id>', 'api.get_role', lambda id: '')
+        lines = []
+        bench(self.app, users=5, posts=5, comments=5, follows=1, requests=1, warmup=0, echo=lines.append)
+        self.assertTrue(any(line.startswith('Skipping api.get_role') for line in lines))
+        self.assertEqual(User.query.count(), 5)
+
+        base = { 'api.get_post': { 'rps': 100, 'p50': 5, 'p95': 10, 'p99': 12, 'queries': 1 } }
+        self.assertEqual(compare({ 'api.get_post': { 'rps': 90, 'p50': 5, 'p95': 11, 'p99': 30, 'queries': 1 } }, base), [])
+        regressions = compare({ 'api.get_post': { 'rps': 50, 'p50': 9, 'p95': 20, 'p99': 30, 'queries': 2 } }, base)
+        self.assertEqual(len(regressions), 3)
+
+    def test_metrics(self):
+        self.client.get('/')
+        self.client.get('/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_data(as_text=True)
+        self.assertIn('app_request_duration_seconds_count{endpoint="main.index"} 2', data)
+        self.assertIn('app_requests_total{endpoint="main.index",method="GET",status="200"} 2.0', data)
+        self.assertIn('app_request_duration_seconds_bucket{endpoint="main.index",le="+Inf"} 2', data)
+        self.assertIn('app_template_seconds_total{endpoint="main.index"}', data)
+        self.assertIn('app_cache_entries{cache="render"}', data)
+
+        # the files of every worker are summed
+        with tempfile.TemporaryDirectory() as directory:
+            state = self.app.extensions['metrics']
+            state.directory = directory
+            state.write()
+            with open(os.path.join(directory, 'metrics-1.json'), 'w') as f:
+                json.dump(dict(state.snapshot(), pid=1), f)
+
+            data = self.client.get('/metrics').get_data(as_text=True)
+            self.assertIn('app_request_duration_seconds_count{endpoint="main.index"} 4', data)
+            state.directory = None
+
+        self.app.config['APP_METRICS_TOKEN'] = 'secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', headers={ 'Authorization': 'Bearer secret' })
+        self.assertEqual(response.status_code, 200)
+
+    def test_profiling(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state = self.app.extensions['profiling']
+            state.directory = directory
+
+            # the header alone does not profile anonymous requests
+            response = self.client.get('/', headers={ 'X-Profile': '1' })
+            self.assertNotIn('X-Profile', response.headers)
+            self.assertEqual(state.names(), [])
+
+            # nor those of other users, on pages and in the API
+            user = Role.query.filter_by(name='User').first()
+            susan = User(email='susan@example.com', username='susan', password='dog', confirmed=True, role=user)
+            db.session.add(susan)
+            db.session.commit()
+            api_headers = { 'X-Profile': '1', 'Accept': 'application/json',
+                            'Authorization': 'Basic ' + b64encode(b'susan@example.com:dog').decode('utf-8') }
+            with mock.patch('app.profiling.cProfile.Profile') as profile:
+                self.client.post('/auth/login', data={ 'email': 'susan@example.com', 'password': 'dog' })
+                response = self.client.get('/', headers={ 'X-Profile': '1' })
+                self.assertNotIn('X-Profile', response.headers)
+                self.client.get('/auth/logout')
+                response = self.client.get('/api/v1/posts/', headers=api_headers)
+                self.assertNotIn('X-Profile', response.headers)
+                profile.assert_not_called()
+
+            admin = Role.query.filter_by(name='Administrator').first()
+            u = User(email='john@example.com', username='john', password='cat', confirmed=True, role=admin)
+            db.session.add(u)
+            db.session.commit()
+            api_headers['Authorization'] = 'Basic ' + b64encode(b'john@example.com:cat').decode('utf-8')
+            response = self.client.get('/api/v1/posts/', headers=api_headers)
+            self.assertIn(response.headers['X-Profile'], state.names())
+            self.client.post('/auth/login', data={ 'email': 'john@example.com', 'password': 'cat' })
+            response = self.client.get('/', headers={ 'X-Profile': '1' })
+            name = response.headers['X-Profile']
+            self.assertIn(name, state.names())
+
+            response = self.client.get('/profiles')
+            self.assertIn(name, response.get_data(as_text=True))
+            response = self.client.get(f'/profiles/{name}')
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(f'/profiles/{name}?format=collapsed')
+            self.assertIn('(index)', response.get_data(as_text=True))
+            self.assertEqual(self.client.get('/profiles/..%2Fconfig.prof').status_code, 404)
+
+            # sampled requests are kept for any user
+            self.client.get('/auth/logout')
+            state.sample_rate = 1.0
+            self.client.get('/')
+            self.assertEqual(len(state.names()), 3)
+
+    def test_index_advisor(self):
+        from app.index_advisor import advise, load
+        with tempfile.TemporaryDirectory() as directory:
+            log = os.path.join(directory, 'queries.log')
+            self.app.config['APP_QUERY_LOG'] = log
+            u = User(email='john@example.com', username='john', password='cat')
+            p = Post(body='post', author=u)
+            db.session.add_all([u, p, Comment(body='comment', author=u, post=p)])
+            db.session.commit()
+            self.client.get(f'/post/{p.id}')
+            self.client.get(f'/post/{p.id}')
+            self.client.get('/followers/john')
+
+            statements = [entry['statement'] for entry in load(log)]
+            self.assertEqual(len(statements), len(set(statements)))
+            comments = next(statement for statement in statements if 'FROM comments' in statement)
+
+            lines = []
+            advise(log, echo=lines.append)
+            # comments of a post and followers of a user are read through the new indexes
+            self.assertNotIn(comments, lines)
+            self.assertFalse(any('follows' in line and 'SCAN' in line for line in lines))
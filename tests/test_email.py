@@ -0,0 +1,98 @@
+import socket, unittest
+from flask_mail import Message
+from app import create_app, db, mail
+from app.email import mail_queue
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
+
+
+class RecordingHandler:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.failures:
+            self.failures -= 1
+            return '451 Try again later'
+
+        self.messages.append(envelope)
+        return '250 OK'
+
+
+class EmailTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self) -> None:
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def message(self, i):
+        return Message(f'Message {i}', sender='admin@example.com', recipients=[f'user{i}@example.com'], body='test')
+
+    def test_queue(self):
+        with mail.record_messages() as outbox:
+            for i in range(20):
+                mail_queue.put(self.message(i))
+
+            self.assertTrue(mail_queue.flush(timeout=10))
+
+        self.assertEqual(len(outbox), 20)
+        stats = mail_queue.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['sent'], 20)
+        self.assertLessEqual(stats['workers'], self.app.config['APP_MAIL_WORKERS'])
+
+    def test_unreachable_server(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+
+        # nothing listens on the port, every connection is refused
+        self.app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_USE_SSL=False,
+                               MAIL_SUPPRESS_SEND=False, APP_MAIL_RETRY_BACKOFF=0.01, APP_MAIL_MAX_RETRIES=2)
+        mail.init_app(self.app)
+        mail_queue.init_app(self.app)
+        mail_queue.put(self.message(0))
+        self.assertTrue(mail_queue.flush(timeout=10))
+
+        stats = mail_queue.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['retried'], 2)
+        self.assertEqual(stats['failed'], 1)
+
+    @unittest.skipUnless(Controller, 'aiosmtpd is not installed')
+    def test_smtp_delivery(self):
+        handler = RecordingHandler(failures=2)
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+
+        controller = Controller(handler, hostname='127.0.0.1', port=port)
+        controller.start()
+        try:
+            self.app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port,
+                                   MAIL_USE_SSL=False, MAIL_SUPPRESS_SEND=False, APP_MAIL_RETRY_BACKOFF=0.01)
+            mail.init_app(self.app)
+            mail_queue.init_app(self.app)
+            for i in range(10):
+                mail_queue.put(self.message(i))
+
+            self.assertTrue(mail_queue.flush(timeout=10))
+        finally:
+            controller.stop()
+
+        # temporary failures are retried
+        self.assertEqual(len(handler.messages), 10)
+        stats = mail_queue.stats()
+        self.assertEqual(stats['sent'], 10)
+        self.assertEqual(stats['retried'], 2)
+        self.assertEqual(stats['failed'], 0)
@@ -0,0 +1,122 @@
+import unittest, json, os, shutil, tempfile, time
+from base64 import b64encode
+from app import create_app, db
+from app.models import User, Role, Post
+from config import config, TestingConfig
+
+
+class ReplicasTestCase(unittest.TestCase):
+    def setUp(self):
+        # Two SQLite files stand in for the primary and its replica, replication is a copy
+        self.directory = tempfile.mkdtemp()
+        self.primary = os.path.join(self.directory, 'primary.sqlite')
+        self.replica = os.path.join(self.directory, 'replica.sqlite')
+        config['replicas'] = type('ReplicasTestingConfig', (TestingConfig,), {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.primary,
+            'APP_READ_REPLICAS': ['sqlite:///' + self.replica],
+            'APP_REPLICA_LAG_INTERVAL': 3600
+        })
+
+        self.app = create_app('replicas')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        u = User(email='john@example.com', password='cat', confirmed=True,
+                 role=Role.query.filter_by(name='User').first())
+        db.session.add_all([u, Post(body='replicated', author=u)])
+        db.session.commit()
+        self.state = self.app.extensions['replicas']
+        self.replicate()
+        self.state.check()
+        self.replicate()
+        self.client = self.app.test_client(use_cookies=True)
+
+    def tearDown(self):
+        self.state.stop()
+        db.session.remove()
+        for engine in self.state.engines.values():
+            engine.dispose()
+        db.get_engine(self.app).dispose()
+        self.app_context.pop()
+        del config['replicas']
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def replicate(self):
+        db.session.remove()
+        for engine in self.state.engines.values():
+            engine.dispose()
+        shutil.copy(self.primary, self.replica)
+
+    def get_api_headers(self):
+        return {
+            'Authorization': 'Basic ' + b64encode(b'john@example.com:cat').decode('utf-8'),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        }
+
+    def get_post_count(self, client):
+        # requests share the session of the pushed app context, in the app every request starts a new one
+        db.session.remove()
+        response = client.get('/api/v1/posts/', headers=self.get_api_headers())
+        self.assertEqual(response.status_code, 200)
+        return len(json.loads(response.get_data(as_text=True))['posts'])
+
+    def test_routing(self):
+        # the replica holds the last heartbeat
+        self.state.check()
+        self.assertEqual(self.state.lag, { 'replica_0': 0.0 })
+
+        # a post the replica has not seen yet is not listed by GET requests
+        db.session.add(Post(body='not replicated', author=User.query.first()))
+        db.session.commit()
+        self.assertEqual(self.get_post_count(self.client), 1)
+
+        # a write keeps its client on the primary
+        response = self.client.post('/api/v1/posts/', headers=self.get_api_headers(),
+                                    data=json.dumps({ 'body': 'written' }))
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(self.app.config['APP_REPLICA_COOKIE'], response.headers['Set-Cookie'])
+        self.assertEqual(self.get_post_count(self.client), 3)
+        self.assertEqual(self.get_post_count(self.app.test_client()), 1)
+
+        # a lagging replica is skipped
+        self.state.check()
+        self.assertGreater(self.state.lag['replica_0'], 0)
+        self.state.max_lag = 0
+        self.assertEqual(self.get_post_count(self.app.test_client()), 3)
+
+        # until it caught up
+        self.replicate()
+        self.state.check()
+        self.assertEqual(self.state.lag['replica_0'], 0)
+        self.assertEqual(self.get_post_count(self.app.test_client()), 3)
+
+    def test_authentication_reads_primary(self):
+        # a password change the replica has not seen yet
+        self.state.check()
+        u = User.query.first()
+        u.password = 'dog'
+        db.session.commit()
+        db.session.remove()
+
+        headers = self.get_api_headers()
+        response = self.app.test_client().get('/api/v1/posts/', headers=headers)
+        self.assertEqual(response.status_code, 401)
+        headers['Authorization'] = 'Basic ' + b64encode(b'john@example.com:dog').decode('utf-8')
+        response = self.app.test_client().get('/api/v1/posts/', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_background_check(self):
+        # requests start the measuring thread instead of checking themselves
+        self.state.check()
+        self.state.interval = 0.05
+        self.assertEqual(self.get_post_count(self.client), 1)
+        self.assertTrue(self.state.thread.is_alive())
+
+        # the replica misses the heartbeats written since
+        deadline = time.monotonic() + 5
+        while not self.state.lag['replica_0'] and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        self.assertGreater(self.state.lag['replica_0'], 0)
@@ -1,6 +1,9 @@
 import unittest, time
-from app.models import User, AnonymousUser, Role, Permission, Follow
+from app.models import User, AnonymousUser, Role, Permission, Follow, Post, TimelineEntry, Comment, load_user
 from app import create_app, db
+from app.last_seen import last_seen
+from app.hashing import hasher, _HashingState
+from werkzeug.exceptions import ServiceUnavailable
 from datetime import datetime
 
 
@@ -182,8 +185,286 @@ class UserModelTestCase(unittest.TestCase):
         db.session.commit()
         with self.app.test_request_context('/'):
             json_user = u.to_json()
-            expected_keys = ['url', 'username', 'member_since', 'last_seen',
+            expected_keys = ['id', 'url', 'username', 'member_since', 'last_seen',
                             'posts_url', 'followed_posts_url', 'post_count']
 
         self.assertEqual(sorted(json_user.keys()), sorted(expected_keys))
         self.assertEqual('/api/v1/users/' + str(u.id), json_user['url'])
+
+    def test_timeline(self):
+        u1 = User(email='john@gmail.com', password='test1')
+        u2 = User(email='susan@gmail.com', password='test2')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p1 = Post(body='first post', author=u2)
+        db.session.add(p1)
+        db.session.commit()
+
+        # following backfills the timeline
+        u1.follow(u2)
+        db.session.commit()
+        self.assertTrue(TimelineEntry.query.filter_by(user_id=u1.id, post_id=p1.id).first() is not None)
+
+        # new posts are pushed to the followers
+        p2 = Post(body='second post', author=u2)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(sorted(p.id for p in u1.followed_posts), sorted([p1.id, p2.id]))
+        self.assertEqual([p.id for p in u2.followed_posts.order_by(Post.id)], [p1.id, p2.id])
+
+        # unfollowing prunes the timeline
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.count(), 0)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u1.id).count(), 0)
+
+    def test_timeline_pull_on_read(self):
+        self.app.config['APP_TIMELINE_FANOUT_LIMIT'] = 4
+        u1 = User(email='john@gmail.com', password='test1')
+        u2 = User(email='susan@gmail.com', password='test2')
+        others = [User(email=f'user{i}@gmail.com', password='test') for i in range(3)]
+        db.session.add_all([u1, u2] + others)
+        db.session.commit()
+        for u in [u1] + others:
+            u.follow(u2)
+        db.session.commit()
+        p = Post(body='popular post', author=u2)
+        db.session.add(p)
+        db.session.commit()
+        self.assertTrue(u2.timeline_pull)
+        self.assertEqual(TimelineEntry.query.filter_by(post_id=p.id).count(), 0)
+        self.assertEqual([post.id for post in u1.followed_posts], [p.id])
+        self.assertEqual(u1.timeline()[1], (Post.timestamp, Post.id))
+
+        # back at half the limit the posts are pushed to the followers again
+        for u in others:
+            u.unfollow(u2)
+        db.session.commit()
+        db.session.refresh(u2)
+        self.assertFalse(u2.timeline_pull)
+        self.assertEqual(TimelineEntry.query.filter_by(post_id=p.id).count(), 2)
+        query, columns = u1.timeline()
+        self.assertEqual([post.id for post in query], [p.id])
+        self.assertEqual([column.key for column in columns], ['timestamp', 'id'])
+
+        # deleting a post removes it from the timelines first
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_rebuild_timelines(self):
+        self.app.config['APP_TIMELINE_BACKFILL'] = 2
+        users = [User(email=f'user{i}@gmail.com', password='test') for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        posts = [Post(body=f'post {i}', author=users[1], timestamp=datetime(2026, 1, 1 + i)) for i in range(3)]
+        db.session.add_all(posts)
+        db.session.commit()
+        users[0].follow(users[1])
+        users[2].follow(users[1])
+        db.session.commit()
+        TimelineEntry.query.delete()
+        db.session.commit()
+
+        # every follow brings only its latest posts, across batches
+        User.rebuild_timelines(batch_size=2)
+        self.assertEqual([p.id for p in users[0].followed_posts.order_by(Post.id)], [posts[1].id, posts[2].id])
+        self.assertEqual([p.id for p in users[2].followed_posts.order_by(Post.id)], [posts[1].id, posts[2].id])
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=users[1].id).count(), 2)
+
+    def test_counters(self):
+        u1 = User(email='john@gmail.com', password='test1')
+        u2 = User(email='susan@gmail.com', password='test2')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        p = Post(body='post', author=u2)
+        c = Comment(body='comment', author=u1, post=p)
+        db.session.add_all([p, c])
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u1.follower_count, u1.post_count), (2, 1, 0))
+        self.assertEqual((u2.followed_count, u2.follower_count, u2.post_count), (1, 2, 1))
+        self.assertEqual(p.comment_count, 1)
+
+        db.session.delete(c)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(p.comment_count, 0)
+        self.assertEqual((u1.followed_count, u2.follower_count), (1, 1))
+
+        # drifted counters are repaired by a recount
+        u2.post_count = 42
+        db.session.commit()
+        User.recount_counters()
+        Post.recount_counters()
+        db.session.commit()
+        self.assertEqual(u2.post_count, 1)
+
+    def test_follow_cache(self):
+        u1 = User(email='john@gmail.com', password='test1')
+        u2 = User(email='susan@gmail.com', password='test2')
+        u3 = User(email='david@gmail.com', password='test3')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u2.follow(u1)
+        db.session.commit()
+
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.test_request_context('/'):
+            u1.preload_follows([u2, u3])
+            db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+            try:
+                self.assertFalse(u1.is_following(u2))
+                self.assertTrue(u1.is_followed_by(u2))
+                self.assertTrue(u2.is_following(u1))
+                self.assertFalse(u1.is_following(u3))
+                self.assertFalse(u3.is_following(u1))
+            finally:
+                db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+            self.assertEqual(statements, [])
+            u1.follow(u3)
+            self.assertTrue(u1.is_following(u3))
+
+    def test_buffered_last_seen(self):
+        self.app.config['APP_LAST_SEEN_FLUSH_INTERVAL'] = 60
+        u1 = User(password='test1')
+        u2 = User(password='test2')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        before = u1.last_seen
+        time.sleep(1)
+        last_seen.touch(u1.id)
+        last_seen.touch(u2.id)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, before)
+
+        last_seen.flush()
+        db.session.expire_all()
+        self.assertTrue(u1.last_seen > before)
+        self.assertTrue(u2.last_seen > before)
+
+        # repeated touches inside the interval are skipped
+        last_seen.touch(u1.id)
+        self.assertEqual(self.app.extensions['last_seen'].pending, {})
+
+    def test_rerender(self):
+        from app.render import rerender
+        u = User(email='john@gmail.com', password='test')
+        p = Post(body='*first*', author=u)
+        c = Comment(body='**second**', author=u, post=p)
+        db.session.add_all([u, p, c])
+        db.session.commit()
+        Post.query.update({ 'body_html': None })
+        Comment.query.update({ 'body_html': None })
+        db.session.commit()
+
+        rerender(chunk_size=1, processes=2, echo=lambda message: None)
+        db.session.expire_all()
+        self.assertEqual(p.body_html, '<p><em>first</em></p>')
+        self.assertEqual(c.body_html, '<strong>second</strong>')
+
+    def test_seed(self):
+        from app.fake import seed
+        from app.render import render_html, POST_ALLOWED_TAGS
+        until = datetime(2026, 1, 1)
+        def dataset():
+            seed(users=30, posts=100, comments=150, follows=4, seed=7, until=until,
+                 chunk_size=60, processes=2, echo=lambda message: None)
+            return [db.session.query(model).order_by(*model.__table__.primary_key).all()
+                    for model in (User, Follow, Post, Comment)]
+
+        users, follows, posts, comments = dataset()
+        self.assertEqual((len(users), len(posts), len(comments)), (30, 100, 150))
+        self.assertTrue(users[0].verify_password('test'))
+        self.assertTrue(all(u.is_following(u) for u in users))
+        self.assertEqual(sum(u.post_count for u in users), 100)
+        self.assertEqual(sum(u.follower_count for u in users), len(follows))
+        self.assertEqual(sum(p.comment_count for p in posts), 150)
+        self.assertEqual(posts[0].body_html, render_html(posts[0].body, POST_ALLOWED_TAGS))
+        self.assertEqual(users[0].followed_posts.count(),
+                         Post.query.join(Follow, Follow.followed_id == Post.author_id)
+                         .filter(Follow.follower_id == users[0].id).count())
+
+        # the same seed gives the same data
+        first = [(u.username, u.email) for u in users], [(f.follower_id, f.followed_id) for f in follows], \
+                [(p.body, p.author_id, p.timestamp) for p in posts], [(c.post_id, c.author_id) for c in comments]
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        Role.insert_roles()
+        users, follows, posts, comments = dataset()
+        second = [(u.username, u.email) for u in users], [(f.follower_id, f.followed_id) for f in follows], \
+                 [(p.body, p.author_id, p.timestamp) for p in posts], [(c.post_id, c.author_id) for c in comments]
+        self.assertEqual(first, second)
+
+    def test_identity_cache(self):
+        u = User(email='john@gmail.com', username='john', password='test')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        db.session.remove()
+        self.assertEqual(load_user(user_id).username, 'john')
+        db.session.remove()
+
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            user = load_user(user_id)
+            self.assertEqual(user.username, 'john')
+            self.assertTrue(user.can(Permission.WRITE))
+            self.assertFalse(user.is_administrator())
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertEqual(statements, [])
+
+        # changes of the cached columns invalidate the entry
+        user.username = 'johnny'
+        user.role = Role.query.filter_by(name='Administrator').first()
+        db.session.commit()
+        db.session.remove()
+        user = load_user(user_id)
+        self.assertEqual(user.username, 'johnny')
+        self.assertTrue(user.is_administrator())
+
+    def test_hashing_pool(self):
+        self.app.config['APP_HASHING_PROCESSES'] = 1
+        self.app.config['APP_HASHING_QUEUE_SIZE'] = 0
+        state = self.app.extensions['hashing'] = _HashingState(self.app)
+        u = User(password='cat')
+        self.assertTrue(u.verify_password('cat'))
+        self.assertFalse(u.verify_password('dog'))
+        self.assertEqual(hasher.stats()['calls'], 3)
+        self.assertEqual(hasher.stats()['depth'], 0)
+
+        # a full queue rejects instead of waiting
+        state.slots.acquire()
+        try:
+            with self.assertRaises(ServiceUnavailable):
+                u.verify_password('cat')
+        finally:
+            state.slots.release()
+            state.executor.shutdown()
+
+        self.assertEqual(hasher.stats()['rejected'], 1)
+
+        # a timed out hash holds its slot until the pool is done with it
+        state = self.app.extensions['hashing'] = _HashingState(self.app)
+        state.timeout = 0.05
+        try:
+            with self.assertRaises(ServiceUnavailable):
+                state.run(time.sleep, 0.5)
+            self.assertEqual(hasher.stats()['depth'], 1)
+            with self.assertRaises(ServiceUnavailable):
+                u.verify_password('cat')
+            time.sleep(1)
+            self.assertEqual(hasher.stats()['depth'], 0)
+        finally:
+            state.executor.shutdown()